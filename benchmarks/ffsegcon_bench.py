@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# encoding=utf8
+"""Benchmark phases of `mylib.ffmpeg.FFmpegSegmentsContainer` on synthetic media, offline.
+
+run:        python3 benchmarks/ffsegcon_bench.py -o result.json
+compare:    python3 benchmarks/ffsegcon_bench.py --compare old.json new.json
+"""
+
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mylib.ffmpeg import FFmpegSegmentsContainer, FFmpegArgsList, probe_cache  # noqa: E402
+from mylib.os_util import read_json_file, write_json_file  # noqa: E402
+
+CASES = {
+    'small': {'size': '640x360', 'duration': 30},
+    'hd': {'size': '1280x720', 'duration': 60},
+    'fhd': {'size': '1920x1080', 'duration': 60},
+}
+PHASES = ('split', 'estimate', 'convert', 'merge')
+
+
+def make_synthetic_video(path: str, size: str, duration: float, rate: int = 30, gop: int = 60):
+    """testsrc2 video (h264, keyframe every `gop` frames) with sine audio, in mkv"""
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+           '-f', 'lavfi', '-i', 'testsrc2=size={}:rate={}:duration={}'.format(size, rate, duration),
+           '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000:duration={}'.format(duration),
+           '-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(gop), '-pix_fmt', 'yuv420p',
+           '-c:a', 'aac', '-shortest', path]
+    subprocess.run(cmd, check=True)
+
+
+def time_subprocess_overhead(n: int = 20) -> float:
+    """mean seconds of spawning ffmpeg that does nothing"""
+    t0 = time()
+    for _ in range(n):
+        subprocess.run(['ffmpeg', '-hide_banner', '-version'], stdout=subprocess.DEVNULL)
+    return (time() - t0) / n
+
+
+def bench_case(name: str, size: str, duration: float, work_dir: str, workers: int, segment_duration: float):
+    video = os.path.join(work_dir, '{}.mkv'.format(name))
+    make_synthetic_video(video, size, duration)
+    probe_cache.data.clear()
+    r = {'size': size, 'duration': duration, 'workers': workers}
+
+    t0 = time()
+    c = FFmpegSegmentsContainer(video, segment_duration=segment_duration)
+    r['split'] = time() - t0
+    c.config_video(FFmpegArgsList(vcodec='libx264', preset='veryfast', threads=2), crf=28)
+
+    t0 = time()
+    c.estimate(samples=4, workers=workers, sample_seconds=2)
+    r['estimate'] = time() - t0
+
+    t0 = time()
+    c.convert(workers=workers)
+    r['convert'] = time() - t0
+    r['segments'] = len(c.get_all_segments())
+    r['convert_per_segment'] = r['convert'] * workers / max(r['segments'], 1)
+
+    c.config_filename('{}.out.mkv'.format(name))
+    t0 = time()
+    c.merge()
+    r['merge'] = time() - t0
+    c.purge()
+    return {k: round(v, 4) if isinstance(v, float) else v for k, v in r.items()}
+
+
+def git_commit() -> str:
+    p = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+    return p.stdout.decode().strip()
+
+
+def run(cases, workers: int, segment_duration: float, output: str = None) -> dict:
+    work_dir = tempfile.mkdtemp(prefix='ffsegcon-bench-')
+    try:
+        result = {'commit': git_commit(), 'python': platform.python_version(), 'machine': platform.machine(),
+                  'cpu_count': os.cpu_count(), 'subprocess_overhead': round(time_subprocess_overhead(), 4),
+                  'cases': {}}
+        for name in cases:
+            result['cases'][name] = bench_case(name, work_dir=work_dir, workers=workers,
+                                               segment_duration=segment_duration, **CASES[name])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if output:
+        write_json_file(output, result, indent=4)
+    return result
+
+
+def compare(old_file: str, new_file: str):
+    old, new = read_json_file(old_file), read_json_file(new_file)
+    print('{} -> {}'.format(old.get('commit'), new.get('commit')))
+    for name in new['cases']:
+        if name not in old['cases']:
+            continue
+        for phase in PHASES:
+            a, b = old['cases'][name][phase], new['cases'][name][phase]
+            print('{:8}{:10}{:10.3f}s{:10.3f}s{:+9.1%}'.format(name, phase, a, b, (b - a) / a if a else 0))
+
+
+def main():
+    ap = ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('-c', '--case', nargs='+', choices=list(CASES), default=list(CASES))
+    ap.add_argument('-w', '--workers', type=int, default=2)
+    ap.add_argument('-d', '--segment-duration', type=float, default=4)
+    ap.add_argument('-o', '--output', help='JSON result file')
+    ap.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON result files')
+    args = ap.parse_args()
+    if args.compare:
+        compare(*args.compare)
+    else:
+        from pprint import pprint
+        pprint(run(args.case, args.workers, args.segment_duration, args.output))
+
+
+if __name__ == '__main__':
+    main()
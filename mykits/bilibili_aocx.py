@@ -16,6 +16,8 @@ def parse_args():
     ap = argparse.ArgumentParser(**common_parser_kwargs,
                                  description='bilibili APP offline cache extractor')
     ap.add_argument('-c', '--cookies', help='netscape format cookies (text) file', metavar='<cookies_file>')
+    ap.add_argument('-w', '--workers', type=int, default=1, help='number of parts merged at once',
+                    metavar='<workers>')
     ap.add_argument('folder', metavar='<folder>',
                     help='a bilibili app offline cache entry folder, usually named in digits, wildcard glob supported')
     return ap.parse_args()
@@ -29,7 +31,7 @@ def main():
         if not os.path.isdir(folder):
             continue
         b = BilibiliAppCacheEntry(folder, cookies)
-        b.extract_part()
+        b.extract_part(workers=args.workers)
 
 
 if __name__ == '__main__':
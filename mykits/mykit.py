@@ -126,6 +126,63 @@ ffprobe.add_argument('-s', '--select-streams')
 ffprobe.add_argument('file', nargs='?')
 
 
+def ffsegcon_worker_func():
+    from mylib.ffmpeg import FFmpegSegmentsContainer
+    args = rtd.args
+    FFmpegSegmentsContainer.file_lock.lease = args.lease
+    FFmpegSegmentsContainer.file_lock.heartbeat = args.heartbeat
+    for path in args.path:
+        FFmpegSegmentsContainer(path).work(workers=args.workers, cpu_budget=args.cpu_budget,
+                                           poll_interval=args.poll_interval, merge=args.merge)
+
+
+ffsegcon_worker = add_sub_parser('ffsegcon.worker', ['ffscw'],
+                                 'convert segments of ffmpeg segments container(s), shared with other hosts')
+ffsegcon_worker.set_defaults(func=ffsegcon_worker_func)
+ffsegcon_worker.add_argument('-w', '--workers', type=int, default=1, metavar='N',
+                             help='concurrent ffmpeg processes, 0 for auto (by cpu cores and -threads)')
+ffsegcon_worker.add_argument('-c', '--cpu-budget', type=int, metavar='N', help='cpu cores to use in auto mode')
+ffsegcon_worker.add_argument('-l', '--lease', type=float, default=120, metavar='SEC',
+                             help='lock lease, locks not renewed within it could be reclaimed')
+ffsegcon_worker.add_argument('-b', '--heartbeat', type=float, default=30, metavar='SEC', help='lock renew interval')
+ffsegcon_worker.add_argument('-p', '--poll-interval', type=float, default=10, metavar='SEC',
+                             help='wait interval for segments locked by others')
+ffsegcon_worker.add_argument('-m', '--merge', action='store_true', help='merge after all segments done')
+ffsegcon_worker.add_argument('path', nargs='+', help='video file or container folder')
+
+
+def ffsegcon_calibrate_func():
+    from mylib.ffmpeg import calibrate_encoder_profiles
+    from pprint import pprint
+    args = rtd.args
+    pprint(calibrate_encoder_profiles(args.profile or None, size=args.size, duration=args.duration))
+
+
+ffsegcon_calibrate = add_sub_parser('ffsegcon.calibrate', ['ffscal'],
+                                    'benchmark encoder profiles on local cpu, for predicting encoding time')
+ffsegcon_calibrate.set_defaults(func=ffsegcon_calibrate_func)
+ffsegcon_calibrate.add_argument('-s', '--size', default='1280x720', help='size of reference clip')
+ffsegcon_calibrate.add_argument('-d', '--duration', type=float, default=5, help='duration of reference clip')
+ffsegcon_calibrate.add_argument('profile', nargs='*', help='profile name(s), default to all')
+
+
+def hevc8b_cleanup_func():
+    from mylib.lamb_av_util import choose_between_origin_and_hevc8b_in_tree
+    args = rtd.args
+    for root in args.root:
+        choose_between_origin_and_hevc8b_in_tree(root, recursive=not args.no_recursive, dry_run=args.dry_run,
+                                                 workers=args.workers or None)
+
+
+hevc8b_cleanup = add_sub_parser('hevc8b.cleanup', ['hevc8b'],
+                                'remove the larger one of each __origin__/hevc8b video pair in directory tree(s)')
+hevc8b_cleanup.set_defaults(func=hevc8b_cleanup_func)
+hevc8b_cleanup.add_argument('-n', '--dry-run', action='store_true', help='only report what would be removed')
+hevc8b_cleanup.add_argument('-R', '--no-recursive', action='store_true')
+hevc8b_cleanup.add_argument('-w', '--workers', type=int, default=0, help='number of threads, 0 for auto')
+hevc8b_cleanup.add_argument('root', nargs='+', help='library folder(s)')
+
+
 def file_type_func():
     from filetype import guess
     files = rtd.args.file
@@ -20,7 +20,7 @@ from .cli import LinePrinter
 from .misc import safe_print, safe_basename
 from .os_util import ensure_sigint_signal
 from .tricks import modify_and_import, until_return_try, range_from_expr
-from .lamb_av_util import concat_videos, merge_m4s
+from .lamb_av_util import concat_videos, merge_m4s, run_concat_merge_batch
 from .web_client import cookie_str_from_dict, cookies_dict_from_netscape_file, get_html_element_tree, HTMLElementTree
 
 BILIBILI_VIDEO_URL_PREFIX = 'https://www.bilibili.com/video/'
@@ -458,8 +458,11 @@ class BilibiliAppCacheEntry:
         else:
             return None
 
-    def extract_part(self):
+    def extract_part(self, workers: int = 1) -> list:
+        """extract all parts, media files of `workers` parts are concatenated/merged at once,
+        return outputs failed to merge"""
         print('+ {}'.format(self.folder))
+        jobs = []
         for part in self.part_list:
             self._current_part = part
             print('  + {}'.format(part), end=': ')
@@ -471,11 +474,20 @@ class BilibiliAppCacheEntry:
                 print('    NO JSON META FOUND')
                 continue
             if 'page_data' in meta:
-                self.extract_vupload()
+                job = self.extract_vupload()
             elif 'ep' in meta:
-                self.extract_bangumi()
-
-    def extract_vupload(self):
+                job = self.extract_bangumi()
+            else:
+                job = None
+            if job:
+                jobs.append(job)
+        failed = [job[-1] for job, code in zip(jobs, run_concat_merge_batch(jobs, workers=workers)) if code]
+        for output in failed:
+            safe_print('    MERGE FAILED: {}'.format(output))
+        return failed
+
+    def extract_vupload(self) -> tuple or None:
+        """copy danmaku of current part, return its merge job, see `run_concat_merge_batch()`"""
         title = safe_basename(self._current_meta['title'])
         file_list = glob(os.path.join(self.folder, self._current_part, self._current_meta['type_tag'], '*'))
         ext_list = [f[-4:] for f in file_list]
@@ -498,15 +510,18 @@ class BilibiliAppCacheEntry:
         safe_print(output)
         if '.m4s' in ext_list:
             m4s_list = [f for f in file_list if f[-4:] == '.m4s']
-            merge_m4s(m4s_list, output)
+            job = merge_m4s, m4s_list, output
         elif '.blv' in ext_list:
             blv_list = [f for f in file_list if f[-4:] == '.blv']
-            concat_videos(blv_list, output)
+            job = concat_videos, blv_list, output
         else:
             print('    NO MEDIA STREAM FOUND')
+            job = None
         shutil.copy2(os.path.join(self.folder, self._current_part, 'danmaku.xml'), output[:-3] + 'xml')
+        return job
 
-    def extract_bangumi(self):
+    def extract_bangumi(self) -> tuple:
+        """copy danmaku of current part, return its merge job, see `run_concat_merge_batch()`"""
         title = safe_basename(self._current_meta['title'])
         blv_list = glob(os.path.join(self.folder, self._current_part, self._current_meta['type_tag'], '*.blv'))
         part_title = safe_basename(self._current_meta['ep']['index_title'])
@@ -517,5 +532,5 @@ class BilibiliAppCacheEntry:
             os.mkdir(output_dir)
         output = os.path.join(output_dir, '{}. {}.mp4'.format(str(ep_num).zfill(len(str(self.part_sum))), part_title))
         safe_print(output)
-        concat_videos(blv_list, output)
         shutil.copy2(os.path.join(self.folder, self._current_part, 'danmaku.xml'), output[:-3] + 'xml')
+        return concat_videos, blv_list, output
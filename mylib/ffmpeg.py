@@ -1,21 +1,32 @@
 #!/usr/bin/env python3
 # encoding=utf8
+import asyncio
+import bisect
+import heapq
 import json
+import multiprocessing
 import os
-import random
+import re
 import shutil
 import subprocess
-from time import sleep
-from typing import Iterable, List, Iterator
+import weakref
+from collections import OrderedDict
+from concurrent.futures import as_completed
+from concurrent.futures.process import ProcessPoolExecutor
+from concurrent.futures.thread import ThreadPoolExecutor
+from threading import Lock, Thread, Condition
+from time import sleep, time
+from typing import Iterable, List, Iterator, Callable
 
 import ffmpeg
 import filetype
 
-from .os_util import pushd_context, write_json_file, read_json_file, SubscriptableFileIO, ensure_open_file, \
+from .os_util import pushd_context, write_json_file, read_json_file, ensure_open_file, \
     fs_find_iter, \
-    fs_rename, fs_touch, shlex_double_quotes_join
-from .tricks import hex_hash, decorator_factory_args_choices, remove_from_list, seconds_from_colon_time, \
+    fs_rename, fs_touch, shlex_double_quotes_join, LeaseFileLock
+from .tricks import hex_hash, decorator_factory_args_choices, seconds_from_colon_time, \
     dedup_list
+from .fingerprint import file_fingerprint, sniff_header
 from .log import get_logger
 
 S_ORIGINAL = 'original'
@@ -38,11 +49,21 @@ S_NO_SUBTITLE = 'no subtitle'
 S_NO_DATA = 'no data'
 S_NO_ATTACHMENT = 'no attachment'
 S_FIRST_VIDEO = 'first video'
+S_SPLIT_PLAN = 'split plan'
+S_TELEMETRY = 'telemetry'
+S_AUTO_CRF = 'auto crf'
+S_LOCK = 'lock'
+S_DONE = 'done'
+S_UNLOCK = 'unlock'
+S_PROFILE = 'profile'
+S_SCENE = 'scene'
+S_ADAPTIVE = 'adaptive'
 STREAM_MAP_PRESET_TABLE = {S_ALL: ['0'], S_ONLY_VIDEO: ['0:V'], S_ONLY_AUDIO: ['0:a'],
                            S_ONLY_SUBTITLE: ['0:s'], S_ONLY_ATTACHMENT: ['0:t'], S_ONLY_DATA: ['0:d'],
                            S_NO_VIDEO: ['0', '-0:V'], S_NO_AUDIO: ['0', '-0:a'], S_NO_SUBTITLE: ['0', '-0:s'],
                            S_NO_ATTACHMENT: ['0', '-0:t'], S_NO_DATA: ['0', '-0:d'],
                            S_FIRST_VIDEO: ['0:V:0'], S_ONLY_PICTURE: ['0:v', '-0:V']}
+MKV_UNSUPPORTED_SUBTITLE_TO_CODEC = {'mov_text': 'srt'}  # subtitle codecs matroska can't hold, converted to
 CODEC_NAME_TO_FILEXT_TABLE = {'mjpeg': '.jpg', 'png': '.png', 'hevc': '.mp4', 'h264': '.mp4', 'vp9': '.webm'}
 
 decorator_choose_map_preset = decorator_factory_args_choices({'map_preset': STREAM_MAP_PRESET_TABLE.keys()})
@@ -58,9 +79,78 @@ def filext_from_codec_name(x) -> str:
         raise TypeError(x)
 
 
+class FFprobeCache:
+    """cache of `ffmpeg.probe` results, entries under a store folder kept apart until `drop()`, others in an LRU"""
+
+    def __init__(self, max_entries: int = 4096):
+        self.data = OrderedDict()
+        self.roots = {}  # folder of store -> {key: data}
+        self.max_entries = max_entries
+        self.lock = Lock()
+
+    @staticmethod
+    def make_key(filepath: str, select_streams: str = None) -> tuple:
+        st = os.stat(filepath)
+        return os.path.abspath(filepath), st.st_size, st.st_mtime_ns, select_streams or ''
+
+    def entries_of(self, path: str) -> dict:
+        for root, entries in self.roots.items():
+            if path.startswith(root + os.sep):
+                return entries
+        return self.data
+
+    def probe(self, filepath: str, select_streams: str = None) -> dict:
+        key = self.make_key(filepath, select_streams)
+        with self.lock:
+            entries = self.entries_of(key[0])
+            if key in entries:
+                if entries is self.data:
+                    self.data.move_to_end(key)
+                return entries[key]
+        if select_streams:
+            data = ffmpeg.probe(filepath, select_streams=select_streams)
+        else:
+            data = ffmpeg.probe(filepath)
+        with self.lock:
+            entries = self.entries_of(key[0])
+            entries[key] = data
+            if entries is self.data and len(self.data) > self.max_entries:
+                self.data.popitem(last=False)
+        return data
+
+    def claim(self, root: str) -> dict:
+        # entries of files inside `root`, kept apart from now on, need lock held
+        if root not in self.roots:
+            self.roots[root] = {k: self.data.pop(k) for k in list(self.data) if k[0].startswith(root + os.sep)}
+        return self.roots[root]
+
+    def load(self, store_path: str):
+        root = os.path.dirname(os.path.abspath(store_path))
+        entries = read_json_file(store_path).get('entries', [])
+        with self.lock:
+            d = self.claim(root)
+            for rel_path, size, mtime_ns, select_streams, data in entries:
+                d[os.path.join(root, rel_path), size, mtime_ns, select_streams] = data
+
+    def save(self, store_path: str):
+        root = os.path.dirname(os.path.abspath(store_path))
+        with self.lock:
+            entries = [[os.path.relpath(path, root), size, mtime_ns, select_streams, data]
+                       for (path, size, mtime_ns, select_streams), data in self.claim(root).items()]
+        write_json_file(store_path, {'entries': entries})
+
+    def drop(self, store_path: str):
+        with self.lock:
+            self.roots.pop(os.path.dirname(os.path.abspath(store_path)), None)
+
+
+probe_cache = FFprobeCache()
+probe = probe_cache.probe
+
+
 def excerpt_single_video_stream(filepath: str) -> dict:
     d = {}
-    data = ffmpeg.probe(filepath)
+    data = probe(filepath)
     file_format = data['format']
     streams = data['streams']
     if len(streams) == 1:
@@ -72,22 +162,246 @@ def excerpt_single_video_stream(filepath: str) -> dict:
                 duration = float(single_stream.get('duration', file_format['duration']))
                 d['duration'] = round((duration - start_time), 6)
             except KeyError:
-                d['duration'] = float(file_format['duration'])
-            d['bit_rate'] = int(8 * d['size'] // d['duration'])
+                d['duration'] = float(file_format.get('duration', 0))
+            if not d['duration']:  # e.g. matroska muxed into non-seekable output, without duration
+                d['duration'] = get_real_duration_by_packets(filepath)
+            d['bit_rate'] = int(8 * d['size'] // d['duration']) if d['duration'] else 0
             d['codec_name'] = single_stream['codec_name']
             d['height'] = single_stream['height']
             d['width'] = single_stream['width']
             d['pix_fmt'] = single_stream['pix_fmt']
+            num, _, den = single_stream.get('avg_frame_rate', '0/0').partition('/')
+            if num.isdigit() and den.isdigit() and int(den):
+                d['frame_rate'] = round(int(num) / int(den), 3)
     return d
 
 
+def get_real_duration_by_packets(filepath: str) -> float:
+    """duration of the first video stream, from the end of its last packet, for files missing duration in header"""
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'V:0', '-show_entries', 'packet=pts_time,duration_time',
+           '-of', 'csv=p=0', filepath]
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p.returncode:
+        raise FFmpegCaller.FFmpegError(p.returncode, p.stderr.decode())
+    start = end = None
+    for line in p.stdout.decode().splitlines():
+        pts_time, duration_time = (line.split(',') + [''])[:2]
+        try:
+            t = float(pts_time)
+        except ValueError:
+            continue
+        start = t if start is None else min(start, t)
+        try:
+            t += float(duration_time)
+        except ValueError:
+            pass
+        end = t if end is None else max(end, t)
+    return round(end - start, 6) if start is not None else 0.
+
+
 def get_real_duration(filepath: str) -> float:
-    d = ffmpeg.probe(filepath)['format']
+    d = probe(filepath)['format']
     duration = float(d['duration'])
     start_time = float(d.get('start_time', 0))
     return duration if start_time <= 0 else duration - start_time
 
 
+def get_keyframe_index(filepath: str, stream_index: int or str) -> List[tuple]:
+    """list of (pts_time, bytes_before) of keyframes in a stream, pts_time shifted to start from 0 as ffmpeg does"""
+    start_time = float(probe(filepath)['format'].get('start_time', 0))
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', str(stream_index),
+           '-show_entries', 'packet=pts_time,size,flags', '-of', 'csv=p=0', filepath]
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if p.returncode:
+        raise FFmpegCaller.FFmpegError(p.returncode, p.stderr.decode())
+    keyframes = []
+    total_size = 0
+    for line in p.stdout.decode().splitlines():
+        pts_time, size, flags = (line.split(',') + ['', '', ''])[:3]
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append((round(float(pts_time) - start_time, 6), total_size))
+        if size.isdigit():
+            total_size += int(size)
+    return sorted(keyframes)
+
+
+def plan_segment_times(keyframes: List[tuple], duration: float = None, size: int = None,
+                       scene_cuts: List[float] = None) -> List[float]:
+    """choose keyframes as cut points, so that segments reach `duration` or `size`, or start near scene cuts"""
+    if not keyframes or not (duration or size or scene_cuts):
+        return []
+    key_times = [t for t, _ in keyframes]
+    snapped = set()  # indexes of keyframes nearest to scene cuts, chosen once segment reaches half the size
+    for cut in scene_cuts or []:
+        k = bisect.bisect_left(key_times, cut)
+        if k == len(key_times) or k and cut - key_times[k - 1] <= key_times[k] - cut:
+            k -= 1
+        snapped.add(k)
+    times = []
+    last_time, last_size = keyframes[0]
+    for k, (t, b) in enumerate(keyframes[1:], 1):
+        at_scene_cut = k in snapped
+        if (duration and t - last_time >= duration) or (size and b - last_size >= size) or at_scene_cut and (
+                not (duration or size) or (duration and t - last_time >= duration / 2) or
+                (size and b - last_size >= size / 2)):
+            times.append(round(t, 6))
+            last_time, last_size = t, b
+    return times
+
+
+def analyze_scenes(filepath: str, stream_index: int or str, min_score: float = 0.1,
+                   scale_height: int = 180) -> dict:
+    """{'start', 'cuts': [[pts_time, scene_score], ...], 'activity': [YDIF of each second, ...]} of a video stream"""
+    vf = "scale=-2:{},select='gte(scene,0)',signalstats,metadata=mode=print:file=-".format(scale_height)
+    cmd = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-i', filepath,
+           '-map', '0:{}'.format(stream_index), '-vf', vf, '-f', 'null', '-']
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = []
+    err_reader = Thread(target=lambda: err.append(p.stderr.read()), daemon=True)
+    err_reader.start()
+    start = None
+    t = 0
+    cuts = []
+    sums, counts = [], []
+    for line in p.stdout:
+        line = line.decode().strip()
+        if line.startswith('frame:'):
+            m = re.search(r'pts_time:(\S+)', line)
+            try:
+                t = float(m.group(1))
+            except (AttributeError, ValueError):
+                continue
+            if start is None:
+                start = t
+        elif line.startswith('lavfi.scene_score='):
+            score = float(line.partition('=')[-1])
+            if score >= min_score:
+                cuts.append([round(t, 6), round(score, 4)])
+        elif line.startswith('lavfi.signalstats.YDIF='):
+            second = max(int(t - (start or 0)), 0)
+            while len(sums) <= second:
+                sums.append(0.)
+                counts.append(0)
+            sums[second] += float(line.partition('=')[-1])
+            counts[second] += 1
+    code = p.wait()
+    err_reader.join()
+    if code:
+        raise FFmpegCaller.FFmpegError(code, b''.join(err).decode(errors='replace'))
+    return {'start': start or 0, 'min_score': min_score, 'cuts': cuts,
+            'activity': [round(x / n, 4) if n else None for x, n in zip(sums, counts)]}
+
+
+def linear_regression(xs: List[float], ys: List[float]) -> dict:
+    """least squares fit of y = a + b * x, with variances of a, b (None if less than 3 points)"""
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    sxx = sum([(x - mean_x) ** 2 for x in xs])
+    sxy = sum([(x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)])
+    b = sxy / sxx if sxx else 0
+    a = mean_y - b * mean_x
+    d = {'a': a, 'b': b, 'n': n, 'var_a': None, 'var_b': None, 'cov_ab': None}
+    if n > 2 and sxx:
+        s2 = sum([(y - a - b * x) ** 2 for x, y in zip(xs, ys)]) / (n - 2)
+        d.update(var_a=s2 * (1 / n + mean_x ** 2 / sxx), var_b=s2 / sxx, cov_ab=-mean_x * s2 / sxx)
+    return d
+
+
+def replace_crf(args: List[str], crf: int) -> list:
+    """copy of args with value of `-crf` (or `-global_quality` of qsv) replaced, or `-crf` appended"""
+    args = list(args)
+    for key in ('-crf', '-global_quality'):
+        if key in args:
+            args[args.index(key) + 1] = str(crf)
+            return args
+    return args + ['-crf', str(crf)]
+
+
+def measure_quality(distorted: str, reference: str, metric: str = 'ssim', duration: float = None) -> float:
+    """ssim (All) or vmaf score of `distorted` against `reference`, by ffmpeg built-in filters"""
+    t = ['-t', str(duration)] if duration else []
+    lavfi = '[0:v][1:v]scale2ref[d][r];[d][r]{}'.format({'ssim': 'ssim', 'vmaf': 'libvmaf'}[metric])
+    cmd = ['ffmpeg', '-hide_banner', '-nostats', *t, '-i', distorted, *t, '-i', reference,
+           '-lavfi', lavfi, '-f', 'null', '-']
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = p.stderr.decode()
+    if p.returncode:
+        raise FFmpegCaller.FFmpegError(p.returncode, err)
+    pattern = r'All:([\d.]+)' if metric == 'ssim' else r'VMAF score[:=]\s*([\d.]+)'
+    found = re.findall(pattern, err)
+    if not found:
+        raise FFmpegCaller.FFmpegError(0, 'no {} score found'.format(metric), err)
+    return float(found[-1])
+
+
+ENCODER_PROFILES = {
+    'x264.fast': {'-c:v': 'libx264', '-preset': 'fast', '-crf': 23, '-threads': 4,
+                  '-x264-params': 'rc-lookahead=20'},
+    'x264.slow': {'-c:v': 'libx264', '-preset': 'slow', '-crf': 21, '-threads': 4,
+                  '-x264-params': 'rc-lookahead=40'},
+    'x265.fast': {'-c:v': 'libx265', '-preset': 'fast', '-crf': 26, '-threads': 4,
+                  '-x265-params': 'log-level=error:pools=4:rc-lookahead=20'},
+    'x265.medium': {'-c:v': 'libx265', '-preset': 'medium', '-crf': 26, '-threads': 4,
+                    '-x265-params': 'log-level=error:pools=4:rc-lookahead=25'},
+    'x265.slow': {'-c:v': 'libx265', '-preset': 'slow', '-crf': 24, '-threads': 8,
+                  '-x265-params': 'log-level=error:pools=8:rc-lookahead=40'},
+    'svtav1.8': {'-c:v': 'libsvtav1', '-preset': 8, '-crf': 35, '-threads': 4, '-svtav1-params': 'lp=4'},
+    'svtav1.6': {'-c:v': 'libsvtav1', '-preset': 6, '-crf': 32, '-threads': 8, '-svtav1-params': 'lp=8'},
+    'vp9.good': {'-c:v': 'libvpx-vp9', '-deadline': 'good', '-cpu-used': 2, '-row-mt': 1, '-crf': 32, '-b:v': 0,
+                 '-threads': 4, '-lag-in-frames': 25},
+}
+PROFILE_CALIBRATION_FILE = os.path.join(os.path.expanduser('~'), '.ffsegcon.calibration.json')
+
+
+def register_encoder_profile(name: str, options: dict):
+    ENCODER_PROFILES[name] = options
+
+
+def encoder_profile_args(name: str, **overrides) -> 'FFmpegArgsList':
+    """output args of an encoder profile with options overridden, e.g. `encoder_profile_args('x265.fast', crf=20)`"""
+    options = dict(ENCODER_PROFILES[name])
+    for k, v in overrides.items():
+        key = FFmpegArgsList.option_name(k)
+        hyphenated = '-' + k.replace('_', '-')
+        if key not in options and hyphenated in options:
+            key = hyphenated
+        options[key] = v
+    args = FFmpegArgsList()
+    for k, v in options.items():
+        args.add_kwarg(k, v)
+    return args
+
+
+def calibrate_encoder_profiles(names: Iterable[str] = None, size: str = '1280x720', rate: int = 30,
+                               duration: float = 5, store: str = PROFILE_CALIBRATION_FILE) -> dict:
+    """record fps and pixel rate of every profile encoding testsrc2 on local cpu, skip unavailable encoders"""
+    width, height = [int(x) for x in size.split('x')]
+    ffcmd = FFmpegCaller(banner=False, loglevel='error', overwrite=True, capture_out_err=True, progress=True)
+    results = read_json_file(store) if os.path.isfile(store) else {}
+    for name in names or ENCODER_PROFILES:
+        ffcmd.reset_args()
+        ffcmd.add_args(f='lavfi', i='testsrc2=size={}:rate={}:duration={}'.format(size, rate, duration))
+        ffcmd.add_args(encoder_profile_args(name), an=True, f='null')
+        ffcmd.add_args('-')
+        t0 = time()
+        try:
+            ffcmd.proc_run()
+        except ffcmd.FFmpegError as e:
+            ffcmd.logger.warning('{}: {}'.format(name, e))
+            continue
+        wall_time = time() - t0
+        fps = round(rate * duration / wall_time, 3)
+        results[name] = {'fps': fps, 'pixel_rate': int(fps * width * height), 'size': size}
+    write_json_file(store, results, indent=4)
+    return results
+
+
+def get_profile_pixel_rate(profile: str, store: str = PROFILE_CALIBRATION_FILE) -> float or None:
+    calibrated = (read_json_file(store) if os.path.isfile(store) else {}).get(profile)
+    return calibrated['pixel_rate'] if calibrated else None
+
+
 class FFmpegArgsList(list):
     def __init__(self, *args, **kwargs):
         super(FFmpegArgsList, self).__init__()
@@ -124,26 +438,64 @@ class FFmpegArgsList(list):
         for a in args:
             self.add_arg(a)
         for k, v in kwargs.items():
-            if k in ('x265_params',):
-                self.add_kwarg('-' + k.replace('_', '-'), v)
-            else:
-                self.add_kwarg('-' + k.replace('__', ':'), v)
+            self.add_kwarg(self.option_name(k), v)
         return self
 
+    @staticmethod
+    def option_name(key: str) -> str:
+        """e.g. `b__v` -> `-b:v`, `pix_fmt` -> `-pix_fmt`, `x265_params` -> `-x265-params`"""
+        if key in ('x265_params',):
+            return '-' + key.replace('_', '-')
+        return '-' + key.replace('__', ':')
+
+
+def parse_ffmpeg_progress(block: dict, duration: float = None) -> dict:
+    """parse a block of key=value lines from ffmpeg `-progress`, with eta if `duration` given"""
+
+    def number(x: str, suffix: str = ''):
+        try:
+            return float(x[:-len(suffix)] if suffix and x.endswith(suffix) else x)
+        except (ValueError, TypeError, AttributeError):
+            return None
+
+    d = {'frame': int(number(block.get('frame')) or 0),
+         'fps': number(block.get('fps')),
+         'bitrate': number(block.get('bitrate'), 'kbits/s'),
+         'total_size': int(number(block.get('total_size')) or 0),
+         'speed': number(block.get('speed'), 'x'),
+         'out_time': (number(block.get('out_time_us')) or 0) / 1000000,
+         'end': block.get('progress') == 'end',
+         'eta': None}
+    if duration and d['speed']:
+        d['eta'] = round(max(duration - d['out_time'], 0) / d['speed'], 3)
+    return d
+
 
 class FFmpegCaller:
     exe = 'ffmpeg'
     head = FFmpegArgsList(exe)
     body = FFmpegArgsList()
     capture_stdout_stderr = False
+    progress = False
+    progress_callback = None
+    progress_duration = None
+    stall_timeout = None
+    last_progress = None
+    stderr_tail_size = 64 << 10  # bytes, only the tail of captured stderr is kept
+    pipe_chunk_size = 1 << 20
 
     class FFmpegError(Exception):
         pass
 
     def __init__(self, banner: bool = True, loglevel: str = None, overwrite: bool = None,
-                 capture_out_err: bool = False):
+                 capture_out_err: bool = False, progress: bool = False, progress_callback=None,
+                 stall_timeout: float = None):
         self.logger = get_logger('.'.join((__name__, self.__class__.__name__)))
         self.capture_stdout_stderr = capture_out_err
+        self.progress = progress
+        self.progress_callback = progress_callback
+        self.stall_timeout = stall_timeout
+        self.body = FFmpegArgsList()  # per-instance, not the class-level one shared by all instances
         self.set_head(banner=banner, loglevel=loglevel, overwrite=overwrite)
 
     @property
@@ -175,36 +527,138 @@ class FFmpegCaller:
             return
         self.add_args(map=STREAM_MAP_PRESET_TABLE[map_preset])
 
-    def proc_comm(self, input_bytes: bytes) -> bytes:
-        cmd = self.cmd
-        self.logger.info(shlex_double_quotes_join(cmd))
-        if self.capture_stdout_stderr:
-            p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def iter_input_chunks(self, input_data) -> Iterator[bytes]:
+        if isinstance(input_data, (bytes, bytearray, memoryview)):
+            view = memoryview(input_data)
+            for i in range(0, len(view), self.pipe_chunk_size):
+                yield view[i:i + self.pipe_chunk_size]
+        elif hasattr(input_data, 'read'):
+            yield from iter(lambda: input_data.read(self.pipe_chunk_size), b'')
         else:
-            p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
-        out, err = p.communicate(input_bytes)
-        code = p.returncode
+            yield from input_data
+
+    def stream_proc(self, p: subprocess.Popen, input_data=None, output_writer=None):
+        """feed stdin and drain stdout/stderr of `p` chunk by chunk, return (stdout bytes, stderr tail bytes)"""
+        err_tail = bytearray()
+        threads = []
+        feed_error = []
+
+        def feed():
+            try:
+                for chunk in self.iter_input_chunks(input_data):
+                    p.stdin.write(chunk)
+            except BrokenPipeError:
+                pass
+            except Exception as e:  # e.g. read error of input file, kill ffmpeg before it sees a normal EOF
+                feed_error.append(e)
+                p.kill()
+            finally:
+                try:
+                    p.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        def drain_err():
+            for chunk in iter(lambda: p.stderr.read1(self.pipe_chunk_size), b''):
+                err_tail.extend(chunk)
+                del err_tail[:-self.stderr_tail_size]
+
+        if p.stdin:
+            threads.append(Thread(target=feed, daemon=True))
+        if p.stderr:
+            threads.append(Thread(target=drain_err, daemon=True))
+        for t in threads:
+            t.start()
+        out_chunks = []
+        if p.stdout:
+            write = output_writer.write if output_writer else out_chunks.append
+            for chunk in iter(lambda: p.stdout.read1(self.pipe_chunk_size), b''):
+                write(chunk)
+        p.wait()
+        for t in threads:
+            t.join()
+        if feed_error:
+            raise self.FFmpegError(p.returncode or -1, 'failed to feed stdin: {!r}'.format(feed_error[0]))
+        return b''.join(out_chunks), bytes(err_tail)
+
+    def check_proc(self, code: int, out: bytes, err: bytes) -> bytes:
         if code:
-            raise self.FFmpegError(code, (err or b'<error not captured>').decode())
-        else:
-            if err:
-                self.logger.debug(err.decode())
-            return out or b''
+            raise self.FFmpegError(code, (err or b'<error not captured>').decode(errors='replace'))
+        if err:
+            self.logger.debug(err.decode(errors='replace'))
+        return out or b''
+
+    def proc_comm(self, input_data, capture_stdout: bool = False, output_writer=None) -> bytes:
+        """run with `input_data` (bytes-like, binary file object or iterable of bytes) fed to stdin in chunks"""
+        cmd = self.cmd
+        self.logger.info(shlex_double_quotes_join(cmd))
+        pipe = subprocess.PIPE
+        p = subprocess.Popen(cmd, stdin=pipe, stdout=pipe if capture_stdout or output_writer else None,
+                             stderr=pipe if self.capture_stdout_stderr else None)
+        out, err = self.stream_proc(p, input_data, output_writer=output_writer)
+        return self.check_proc(p.returncode, out, err)
 
     def proc_run(self) -> bytes:
+        if self.progress:
+            return self.proc_run_progress()
         cmd = self.cmd
         self.logger.info(shlex_double_quotes_join(cmd))
         if self.capture_stdout_stderr:
-            p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = self.stream_proc(p)
         else:
-            p = subprocess.run(cmd)
-        code = p.returncode
-        if code:
-            raise self.FFmpegError(code, (p.stderr or b'<error not captured>').decode())
-        else:
-            if p.stderr:
-                self.logger.debug(p.stderr.decode())
-            return p.stdout or b''
+            p = subprocess.Popen(cmd)
+            p.wait()
+            out, err = b'', b''
+        return self.check_proc(p.returncode, out, err)
+
+    def proc_run_progress(self) -> bytes:
+        cmd = self.head + FFmpegArgsList('-nostats', progress='pipe:1') + self.body
+        self.logger.info(shlex_double_quotes_join(cmd))
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE if self.capture_stdout_stderr else None)
+        err_tail = bytearray()
+        last_update = [time()]
+        stalled = []
+        threads = []
+        if p.stderr:
+            def drain_err():
+                for chunk in iter(lambda: p.stderr.read1(self.pipe_chunk_size), b''):
+                    err_tail.extend(chunk)
+                    del err_tail[:-self.stderr_tail_size]
+
+            threads.append(Thread(target=drain_err, daemon=True))
+        if self.stall_timeout:
+            def watchdog():
+                while p.poll() is None:
+                    if time() - last_update[0] > self.stall_timeout:
+                        stalled.append(True)
+                        p.kill()
+                        return
+                    sleep(1)
+
+            threads.append(Thread(target=watchdog, daemon=True))
+        for t in threads:
+            t.start()
+        self.last_progress = None
+        block = {}
+        for line in p.stdout:
+            key, _, value = line.decode().strip().partition('=')
+            block[key] = value
+            last_update[0] = time()
+            if key == 'progress':
+                self.last_progress = parse_ffmpeg_progress(block, self.progress_duration)
+                if self.progress_callback:
+                    self.progress_callback(self.last_progress)
+                block = {}
+        code = p.wait()
+        for t in threads:
+            t.join()
+        err = bytes(err_tail)
+        if stalled:
+            raise self.FFmpegError(code, 'stalled for more than {}s'.format(self.stall_timeout),
+                                   err.decode(errors='replace'))
+        return self.check_proc(code, b'', err)
 
     @decorator_choose_map_preset
     def concat(self, input_paths: Iterable[str] or Iterator[str], output_path: str,
@@ -232,7 +686,7 @@ class FFmpegCaller:
                 self.add_args(safe=0, protocol_whitelist='file', f='concat', i=file)
         else:
             input_count += 1
-            concat_list = '\n'.join(['file \'{}\''.format(e) for e in input_paths])
+            concat_list = '\n'.join(["file '{}'".format(e.replace("'", "'\\''")) for e in input_paths])
             self.add_args(f='concat', safe=0, protocol_whitelist='file,pipe', i='-')
         if extra_inputs:
             input_count += len(extra_inputs)
@@ -271,6 +725,16 @@ class FFmpegCaller:
         self.add_args(output_path)
         return self.proc_run()
 
+    def multi_output(self, input_path: str, outputs: Iterable[tuple] or Iterator[tuple], start: float = 0):
+        self.reset_args()
+        if start:
+            self.add_args(ss=start)
+        self.add_args(i=input_path)
+        for output_path, output_args in outputs:
+            self.add_args(*output_args)
+            self.add_args(output_path)
+        return self.proc_run()
+
     def metadata_file(self, input_path: str, output_path: str):
         self.reset_args()
         self.add_args(i=input_path, f='ffmetadata')
@@ -282,7 +746,7 @@ class FFmpegCaller:
                 output_args: Iterable[str] or Iterator[str] = (), *,
                 start: float or int or str = 0, end: float or int or str = 0,
                 copy_all: bool = False, map_preset: str = None, metadata_file: str = None,
-                **output_kwargs):
+                input_bytes=None, output_writer=None, **output_kwargs):
         if isinstance(start, str):
             start = seconds_from_colon_time(start)
         if isinstance(end, str):
@@ -308,20 +772,102 @@ class FFmpegCaller:
         self.set_map_preset(map_preset)
         self.add_args(*output_args, **output_kwargs)
         self.add_args(output_path)
+        if input_bytes is not None:
+            to_stdout = output_path in ('-', 'pipe:1')
+            return self.proc_comm(input_bytes, capture_stdout=to_stdout,
+                                  output_writer=output_writer if to_stdout else None)
         return self.proc_run()
 
 
+class AsyncFFmpegCaller(FFmpegCaller):
+    """`FFmpegCaller` on asyncio subprocess, methods running ffmpeg return awaitable, at most `max_jobs` at once"""
+
+    def __init__(self, *args, max_jobs: int = None, **kwargs):
+        super(AsyncFFmpegCaller, self).__init__(*args, **kwargs)
+        self.max_jobs = max_jobs or os.cpu_count() or 1
+        self._semaphores = weakref.WeakKeyDictionary()  # event loop -> semaphore, which is bound to its loop
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_jobs)
+        return self._semaphores[loop]
+
+    def proc_comm(self, input_data, capture_stdout: bool = False, output_writer=None):
+        return self.arun(FFmpegArgsList(self.cmd), input_data, capture_stdout=capture_stdout,
+                         output_writer=output_writer)
+
+    def proc_run(self):
+        return self.arun(FFmpegArgsList(self.cmd))
+
+    async def arun(self, cmd: List[str], input_data=None, capture_stdout: bool = False,
+                   output_writer=None) -> bytes:
+        pipe = asyncio.subprocess.PIPE
+        capture = pipe if self.capture_stdout_stderr else None
+        err_tail = bytearray()
+        out_chunks = []
+
+        async def feed():
+            try:
+                for chunk in self.iter_input_chunks(input_data):
+                    p.stdin.write(chunk)
+                    await p.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                p.stdin.close()
+
+        async def drain_out():
+            write = output_writer.write if output_writer else out_chunks.append
+            while True:
+                chunk = await p.stdout.read(self.pipe_chunk_size)
+                if not chunk:
+                    break
+                write(chunk)
+
+        async def drain_err():
+            while True:
+                chunk = await p.stderr.read(self.pipe_chunk_size)
+                if not chunk:
+                    break
+                err_tail.extend(chunk)
+                del err_tail[:-self.stderr_tail_size]
+
+        async with self.semaphore:
+            self.logger.info(shlex_double_quotes_join(cmd))
+            p = await asyncio.create_subprocess_exec(
+                *cmd, stdin=pipe if input_data is not None else None,
+                stdout=pipe if capture_stdout or output_writer else capture, stderr=capture)
+            tasks = [f() for f, stream in ((feed, p.stdin), (drain_out, p.stdout), (drain_err, p.stderr)) if stream]
+            try:
+                await asyncio.gather(*tasks)
+                await p.wait()
+            except asyncio.CancelledError:
+                if p.returncode is None:
+                    p.kill()
+                await p.wait()
+                raise
+        return self.check_proc(p.returncode, b''.join(out_chunks), bytes(err_tail))
+
+
 class FFmpegSegmentsContainer:
     nickname = 'ffsegcon'
     logger = get_logger('.'.join((__name__, nickname)))
-    ffcmd = FFmpegCaller(banner=False, loglevel='warning', overwrite=True, capture_out_err=True)
+    ffcmd = FFmpegCaller(banner=False, loglevel='warning', overwrite=True, capture_out_err=True, progress=True)
+    file_lock = LeaseFileLock()
     tag_file = 'FFMPEG_SEGMENTS_CONTAINER.TAG'
     tag_sig = 'Signature: ' + hex_hash(tag_file.encode())
     picture_file = 'p.mp4'
     non_visual_file = 'nv.mkv'
     test_json = 't.json'
+    test_prefix = 't-'
     metadata_file = 'metadata.txt'
     concat_list_file = 'concat.txt'
+    segment_list_csv = 'segments.csv'
+    split_checkpoint_json = 'split.json'
+    progressive_json = 'progressive.json'
+    scene_json = 'scene.json'
     suffix_done = '.DONE'
     suffix_lock = '.LOCK'
     suffix_delete = '.DELETE'
@@ -336,7 +882,14 @@ class FFmpegSegmentsContainer:
     output_filename_prefix = 'o='
     output_prefix = 'o-'
     output_json = 'o.json'
+    status_journal = 'status.log'
+    probe_cache_file = 'probe.json'  # on-disk probe cache store in container root, None to disable
     output_data = None
+    default_threads_per_job = 4
+    progress_callback = None  # func(stream_id, segment_file, progress_dict)
+    stall_timeout = None
+    _segment_table = None  # SegmentTable, reset whenever input data is written
+    _args_hashes = None  # {(stream_id, segment_file): args hash}, reset whenever input or output data is written
 
     class PathError(Exception):
         pass
@@ -359,7 +912,11 @@ class FFmpegSegmentsContainer:
     def __repr__(self):
         return "{} at '{}' from '{}'".format(FFmpegSegmentsContainer.__name__, self.root, self.input_filepath)
 
-    def __init__(self, path: str, work_dir: str = None, single_video_stream: bool = True):
+    def __init__(self, path: str, work_dir: str = None, single_video_stream: bool = True,
+                 segment_duration: float = None, segment_size: int = None, scene_threshold: float = None):
+        self.status_lock = Lock()
+        self.status_index = {}
+        self.status_offset = 0
         path = os.path.abspath(path)
         select_streams = 'V:0' if single_video_stream else 'V'
         if not os.path.exists(path):
@@ -367,15 +924,14 @@ class FFmpegSegmentsContainer:
 
         if os.path.isfile(path):
             self.input_filepath = path
-            if filetype.guess(path).mime.startswith('video'):
+            fingerprint, header = file_fingerprint(path)
+            kind = filetype.guess(header)
+            if kind and kind.mime.startswith('video'):
                 d, b = os.path.split(path)
                 self.input_data = {S_FILENAME: b, S_SEGMENT: {}, S_NON_SEGMENT: {}}
-                with SubscriptableFileIO(path) as f:
-                    middle = f.size // 2
-                    root_base = '.{}-{}'.format(self.nickname, hex_hash(
-                        f[:4096] + f[middle - 2048:middle + 2048] + f[-4096:])[:8])
+                root_base = '.{}-{}'.format(self.nickname, fingerprint[:8])
                 work_dir = work_dir or d
-                path = self.root = os.path.join(work_dir, root_base)  # file path -> dir path
+                path = self.root = os.path.abspath(os.path.join(work_dir, root_base))  # file path -> dir path
             else:
                 raise self.PathError("non-video file: '{}'".format(path))
 
@@ -385,14 +941,17 @@ class FFmpegSegmentsContainer:
             except FileExistsError:
                 raise self.PathError("invalid folder path used by file: '{}'".format(path))
             self.tag_container_folder()
-            self.split(select_streams=select_streams)
+            self.split(select_streams=select_streams, segment_duration=segment_duration, segment_size=segment_size,
+                       scene_threshold=scene_threshold)
 
         if os.path.isdir(path):
             self.root = path
             if not self.container_is_tagged():
                 raise self.ContainerError("non-container folder: '{}'".format(path))
+            self.load_probe_cache()
             if not self.is_split():
-                self.split(select_streams=select_streams)
+                self.split(select_streams=select_streams, segment_duration=segment_duration,
+                           segment_size=segment_size, scene_threshold=scene_threshold)
             self.read_input_json()
             if S_FILENAME not in self.input_data:
                 self.read_filename()
@@ -402,57 +961,192 @@ class FFmpegSegmentsContainer:
         fn = self.input_data.get(S_FILENAME)
         if not fn:
             return
-        with pushd_context(self.root):
-            prefix = self.input_filename_prefix
-            for f in fs_find_iter(pattern=prefix + '*', recursive=False, strip_root=True):
-                fs_rename(f, prefix + fn, append_src_ext=False)
-                break
-            else:
-                ensure_open_file(prefix + fn)
+        prefix = self.input_filename_prefix
+        for f in fs_find_iter(pattern=prefix + '*', root=self.root, recursive=False, strip_root=False):
+            fs_rename(f, prefix + fn, append_src_ext=False)
+            break
+        else:
+            ensure_open_file(os.path.join(self.root, prefix + fn))
 
     def read_filename(self):
-        with pushd_context(self.root):
-            prefix = self.input_filename_prefix
-            for f in fs_find_iter(pattern=prefix + '*', recursive=False, strip_root=True):
-                filename = f.lstrip(prefix)
-                self.input_data[S_FILENAME] = filename
-                return filename
-            else:
-                raise self.ContainerError('no filename found')
+        prefix = self.input_filename_prefix
+        for f in fs_find_iter(pattern=prefix + '*', root=self.root, recursive=False, strip_root=False):
+            filename = os.path.basename(f).lstrip(prefix)
+            self.input_data[S_FILENAME] = filename
+            return filename
+        else:
+            raise self.ContainerError('no filename found')
 
-    def split(self, select_streams='V:0'):
+    def split(self, select_streams='V:0', segment_duration: float = None, segment_size: int = None,
+              scene_threshold: float = None):
+        """split input file into segments of video stream(s), and other streams into non-segment file(s)"""
         i_file = self.input_filepath
         if not i_file:
             raise self.ContainerError('no input filepath')
         d = self.input_data or {S_SEGMENT: {}, S_NON_SEGMENT: {}}
-
+        streams = probe(i_file)['streams']
+        pictures = [s for s in streams if s['codec_type'] == 'video' and s['disposition'].get('attached_pic')]
+        videos = [s for s in streams if s['codec_type'] == 'video' and s not in pictures]
+        if select_streams == 'V:0':
+            videos = videos[:1]
+        has_picture = bool(pictures)
+        non_visual = [s for s in streams if s['codec_type'] not in ('video', 'data')]  # e.g. tmcd data of mov
+        has_non_visual = bool(non_visual)
+        checkpoint = self.load_split_checkpoint([str(s['index']) for s in videos])
+        resume_time = checkpoint['resume_time']
+        if resume_time:
+            self.logger.info('resume split from {}s'.format(resume_time))
+
+        # every output is produced in a single demux pass of the input file
+        outputs = []
         with pushd_context(self.root):
-            for stream in ffmpeg.probe(i_file, select_streams=select_streams)['streams']:
-                index = stream['index']
-                # codec = stream['codec_name']
-                # suitable_filext = CODEC_NAME_TO_FILEXT_TABLE.get(codec)
-                # segment_output = '%d' + suitable_filext if suitable_filext else None
-                segment_output = '%d.mkv'
-                index = str(index)
+            for stream in videos:
+                index = str(stream['index'])
                 d[S_SEGMENT][index] = {}
                 seg_folder = self.input_prefix + index
                 os.makedirs(seg_folder, exist_ok=True)
-                with pushd_context(seg_folder):
-                    self.ffcmd.segment(i_file, segment_output, map='0:{}'.format(index))
-            try:
-                self.ffcmd.convert([i_file], self.input_picture, copy_all=True, map_preset=S_ONLY_PICTURE)
+                seg_args = FFmpegArgsList(map='0:{}'.format(index), c='copy', f='segment', reset_timestamps=1,
+                                          segment_list=os.path.join(seg_folder, self.segment_list_csv),
+                                          segment_list_type='csv',
+                                          segment_start_number=len(checkpoint['segments'][index]))
+                if segment_duration or segment_size or scene_threshold:
+                    plan = checkpoint['plan']
+                    if index not in plan:
+                        scene_cuts = [t for t, score in self.load_scene_analysis(index)['cuts']
+                                      if score >= scene_threshold] if scene_threshold else None
+                        plan[index] = plan_segment_times(get_keyframe_index(i_file, index),
+                                                         duration=segment_duration, size=segment_size,
+                                                         scene_cuts=scene_cuts)
+                        self.write_split_checkpoint(checkpoint)
+                    times = plan[index]
+                    d.setdefault(S_SPLIT_PLAN, {})[index] = {'duration': segment_duration, 'size': segment_size,
+                                                             'scene_threshold': scene_threshold,
+                                                             'segment_times': times}
+                    rest_times = [round(t - resume_time, 6) for t in times if t > resume_time]
+                    if rest_times:
+                        seg_args.add(segment_times=','.join([str(t) for t in rest_times]))
+                outputs.append((os.path.join(seg_folder, '%d.mkv'), seg_args))
+            side_outputs = []  # (non-segment key, output), dropped one by one from the tail if split fails
+            if has_picture:
+                side_outputs.append((self.picture_file, (self.input_picture, FFmpegArgsList(
+                    map=STREAM_MAP_PRESET_TABLE[S_ONLY_PICTURE], c='copy'))))
                 d[S_NON_SEGMENT][self.picture_file] = {}
-            except self.ffcmd.FFmpegError:
-                pass
-            try:
-                self.ffcmd.convert([i_file], self.input_non_visual, copy_all=True, map_preset=S_ALL, map='-0:v')
+            if has_non_visual:
+                nv_head = self.input_non_visual + '.head.mkv'
+                nv_rest = self.input_non_visual + '.rest.mkv'
+                if os.path.isfile(nv_head):  # left by a resumed split which was interrupted again
+                    head_end = checkpoint.get('non_visual_head') or resume_time
+                    if os.path.isfile(nv_rest):
+                        self.join_resumed_file(nv_head, nv_rest, self.input_non_visual, head_end)
+                        os.remove(nv_rest)
+                    else:
+                        os.replace(nv_head, self.input_non_visual)
+                        self.logger.warning('non-visual streams may be missing after {}s'.format(head_end))
+                    if os.path.isfile(nv_head):
+                        os.remove(nv_head)
+                if resume_time and os.path.isfile(self.input_non_visual):
+                    os.replace(self.input_non_visual, nv_head)
+                    checkpoint['non_visual_head'] = resume_time
+                    self.write_split_checkpoint(checkpoint)
+                nv_args = FFmpegArgsList(map=['0:{}'.format(s['index']) for s in non_visual], c='copy')
+                for k, stream in enumerate(non_visual):
+                    codec = stream.get('codec_name')
+                    if stream['codec_type'] == 'subtitle' and codec in MKV_UNSUPPORTED_SUBTITLE_TO_CODEC:
+                        nv_args.add_kwarg('-c:{}'.format(k), MKV_UNSUPPORTED_SUBTITLE_TO_CODEC[codec])
+                side_outputs.append((self.non_visual_file, (
+                    nv_rest if os.path.isfile(nv_head) else self.input_non_visual, nv_args)))
                 d[S_NON_SEGMENT][self.non_visual_file] = {}
-            except self.ffcmd.FFmpegError:
-                pass
+            while True:
+                try:
+                    self.ffcmd.multi_output(i_file, outputs + [o for _, o in side_outputs], start=resume_time)
+                    break
+                except self.ffcmd.FFmpegError as e:
+                    if not side_outputs:
+                        raise
+                    key, _ = side_outputs.pop()
+                    self.logger.warning('retry split without {}, since: {}'.format(key, e))
+                    del d[S_NON_SEGMENT][key]
+                    if key == self.non_visual_file:
+                        has_non_visual = False
+            if has_non_visual and os.path.isfile(nv_head):
+                self.join_resumed_file(nv_head, nv_rest, self.input_non_visual, resume_time)
+                os.remove(nv_head)
+                os.remove(nv_rest)
 
         self.input_data = d
+        self._segment_table = None
+        self._args_hashes = None
         self.write_metadata()
         self.write_input_json()
+        self.clear_split_checkpoint(d[S_SEGMENT])
+
+    def read_segment_list_csv(self, stream_id, offset: float = 0) -> List[list]:
+        """[filename, start, end] of segments completed by ffmpeg segment muxer, in its csv segment list"""
+        csv_path = os.path.join(self.root, self.input_prefix + stream_id, self.segment_list_csv)
+        entries = []
+        if os.path.isfile(csv_path):
+            with open(csv_path, encoding='utf8') as f:
+                for line in f:
+                    name, start, end = line.strip().rsplit(',', 2)
+                    entries.append([os.path.basename(name.strip('"')), offset + float(start), offset + float(end)])
+        return entries
+
+    def load_split_checkpoint(self, stream_ids: List[str]) -> dict:
+        """complete segments of an interrupted split, and the resume time after them"""
+        cp_file = os.path.join(self.root, self.split_checkpoint_json)
+        cp = read_json_file(cp_file) if os.path.isfile(cp_file) else {}
+        base = cp.get('resume_time', 0)
+        segments = {i: cp.get('segments', {}).get(i, []) + self.read_segment_list_csv(i, offset=base)
+                    for i in stream_ids}
+
+        def tail_is_valid(stream_id, entry):
+            path = os.path.join(self.root, self.input_prefix + stream_id, entry[0])
+            try:
+                info = excerpt_single_video_stream(path)
+            except Exception:
+                return False
+            return bool(info) and abs(info['duration'] - (entry[2] - entry[1])) <= 0.5
+
+        for i, entries in segments.items():
+            while entries and not tail_is_valid(i, entries[-1]):
+                entries.pop()
+        resume_time = min([entries[-1][2] if entries else 0 for entries in segments.values()] or [0])
+        for entries in segments.values():
+            while entries and entries[-1][2] > resume_time + 0.001:
+                entries.pop()
+
+        for i, entries in segments.items():
+            seg_folder = os.path.join(self.root, self.input_prefix + i)
+            kept = {e[0] for e in entries}
+            if os.path.isdir(seg_folder):
+                for f in os.listdir(seg_folder):
+                    if re.match(self.segment_filename_regex_pattern, f) and f not in kept:
+                        os.remove(os.path.join(seg_folder, f))
+                csv_path = os.path.join(seg_folder, self.segment_list_csv)
+                if os.path.isfile(csv_path):
+                    os.remove(csv_path)
+        cp = {'resume_time': round(resume_time, 6), 'segments': segments, 'plan': cp.get('plan', {}),
+              'non_visual_head': cp.get('non_visual_head')}
+        self.write_split_checkpoint(cp)
+        return cp
+
+    def write_split_checkpoint(self, checkpoint: dict):
+        write_json_file(os.path.join(self.root, self.split_checkpoint_json), checkpoint, indent=4)
+
+    def clear_split_checkpoint(self, stream_ids: Iterable[str]):
+        paths = [os.path.join(self.root, self.input_prefix + i, self.segment_list_csv) for i in stream_ids]
+        for path in paths + [os.path.join(self.root, self.split_checkpoint_json)]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def join_resumed_file(self, head: str, rest: str, output: str, resume_time: float):
+        concat_list = "file '{}'\noutpoint {}\nfile '{}'".format(
+            os.path.abspath(head), resume_time, os.path.abspath(rest))
+        ffcmd = self.ffcmd
+        ffcmd.reset_args()
+        ffcmd.add_args(f='concat', safe=0, protocol_whitelist='file,pipe', i='-', map=0, c='copy')
+        ffcmd.add_args(output)
+        return ffcmd.proc_comm(concat_list.encode())
 
     def write_metadata(self):
         with pushd_context(self.root):
@@ -464,58 +1158,113 @@ class FFmpegSegmentsContainer:
             with open(self.metadata_file, 'w', encoding='utf8') as f:
                 f.writelines(meta_lines)
 
-    def write_input_json(self):
+    def write_input_json(self, workers: int = 0):
         d = self.input_data or {}
         prefix = self.input_prefix
-
-        with pushd_context(self.root):
-            for k in d[S_SEGMENT]:
-                seg_folder = prefix + k
-                d[S_SEGMENT][k] = {}
-                with pushd_context(seg_folder):
-                    for file in fs_find_iter(pattern=self.segment_filename_regex_pattern, regex=True,
-                                             recursive=False, strip_root=True):
-                        d[S_SEGMENT][k][file] = excerpt_single_video_stream(file)
-            for k in d[S_NON_SEGMENT]:
-                file = prefix + k
-                if os.path.isfile(file):
-                    d[S_NON_SEGMENT][k] = ffmpeg.probe(file)
-                else:
-                    del d[S_NON_SEGMENT][k]
-            write_json_file(self.input_json, d, indent=4)
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+
+        for k in d[S_SEGMENT]:
+            seg_folder = os.path.join(self.root, prefix + k)
+            paths = list(fs_find_iter(pattern=self.segment_filename_regex_pattern, root=seg_folder, regex=True,
+                                      recursive=False, strip_root=False))
+            files = [os.path.basename(f) for f in paths]
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                d[S_SEGMENT][k] = dict(zip(files, pool.map(excerpt_single_video_stream, paths)))
+            analysis = self.load_scene_analysis(k, analyze=False)
+            if analysis:
+                self.assign_segment_complexity(d[S_SEGMENT][k], analysis)
+        for k in list(d[S_NON_SEGMENT]):
+            file = os.path.join(self.root, prefix + k)
+            if os.path.isfile(file):
+                d[S_NON_SEGMENT][k] = probe(file)
+            else:
+                del d[S_NON_SEGMENT][k]
+        write_json_file(os.path.join(self.root, self.input_json), d, indent=4)
 
         self.input_data = d
+        self._segment_table = None
+        self._args_hashes = None
+        self.save_probe_cache()
+
+    def load_scene_analysis(self, stream_id, analyze: bool = True) -> dict or None:
+        """scene analysis of a video stream, cached in scene json"""
+        scene_file = os.path.join(self.root, self.scene_json)
+        data = read_json_file(scene_file) if os.path.isfile(scene_file) else {}
+        if stream_id in data or not analyze:
+            return data.get(stream_id)
+        if not self.input_filepath:
+            raise self.ContainerError('no input filepath to analyze')
+        self.logger.info('analyze scenes of stream {}'.format(stream_id))
+        data[stream_id] = analyze_scenes(self.input_filepath, stream_id)
+        write_json_file(scene_file, data)
+        return data[stream_id]
+
+    @staticmethod
+    def assign_segment_complexity(segments: dict, analysis: dict):
+        """mean activity of segments relative to the whole stream, 1 for average"""
+        activity = analysis['activity']
+        valid = [x for x in activity if x is not None]
+        overall = sum(valid) / len(valid) if valid else 0
+        if not overall:
+            return
+        t = 0
+        for f in sorted(segments, key=lambda x: int(os.path.splitext(x)[0])):
+            info = segments[f]
+            end = t + info.get('duration', 0)
+            span = [x for x in activity[int(t):max(int(end + 0.5), int(t) + 1)] if x is not None]
+            if span:
+                info['complexity'] = round(sum(span) / len(span) / overall, 3)
+            t = end
+
+    def analyze(self):
+        for stream_id in self.input_data[S_SEGMENT]:
+            self.load_scene_analysis(stream_id)
+        self.write_input_json()
+
+    def load_probe_cache(self):
+        if self.probe_cache_file and os.path.isfile(os.path.join(self.root, self.probe_cache_file)):
+            probe_cache.load(os.path.join(self.root, self.probe_cache_file))
+
+    def save_probe_cache(self):
+        if self.probe_cache_file:
+            probe_cache.save(os.path.join(self.root, self.probe_cache_file))
+
+    def release_probe_cache(self):
+        if self.probe_cache_file:
+            probe_cache.save(os.path.join(self.root, self.probe_cache_file))
+            probe_cache.drop(os.path.join(self.root, self.probe_cache_file))
 
     def read_input_json(self):
-        with pushd_context(self.root):
-            self.input_data = read_json_file(self.input_json)
+        self.input_data = read_json_file(os.path.join(self.root, self.input_json))
+        self._segment_table = None
+        self._args_hashes = None
         self.write_filename()
         return self.input_data
 
     def read_output_json(self):
-        with pushd_context(self.root):
-            self.output_data = read_json_file(self.output_json)
-            if not self.output_data:
-                self.config()
-                self.output_data = read_json_file(self.output_json)
+        output_json = os.path.join(self.root, self.output_json)
+        self.output_data = read_json_file(output_json)
+        self._args_hashes = None
+        if not self.output_data:
+            self.config()
+            self.output_data = read_json_file(output_json)
         return self.output_data
 
     def write_output_json(self):
-        with pushd_context(self.root):
-            write_json_file(self.output_json, self.output_data, indent=4)
+        self._args_hashes = None
+        write_json_file(os.path.join(self.root, self.output_json), self.output_data, indent=4)
 
     def tag_container_folder(self):
-        with pushd_context(self.root):
-            with open(self.tag_file, 'w') as f:
-                f.write(self.tag_sig)
+        with open(os.path.join(self.root, self.tag_file), 'w') as f:
+            f.write(self.tag_sig)
 
     def container_is_tagged(self) -> bool:
-        with pushd_context(self.root):
-            try:
-                with open(self.tag_file) as f:
-                    return f.readline().rstrip('\r\n') == self.tag_sig
-            except FileNotFoundError:
-                return False
+        try:
+            with open(os.path.join(self.root, self.tag_file)) as f:
+                return f.readline().rstrip('\r\n') == self.tag_sig
+        except FileNotFoundError:
+            return False
 
     def is_split(self) -> bool:
         return bool(self.read_input_json())
@@ -637,12 +1386,82 @@ class FFmpegSegmentsContainer:
         conf[S_ORIGINAL]['video_args'] = video_args
         self.config(**conf[S_ORIGINAL])
 
+    def config_profile(self, profile: str, crf: int = None, vf=None, s=None, **overrides):
+        conf = self.read_output_json()
+        if crf is not None:
+            overrides['crf'] = crf
+        video_args = encoder_profile_args(profile, **overrides)
+        video_args.add(vf=vf, s=s)
+        conf[S_ORIGINAL]['video_args'] = video_args
+        self.config(**conf[S_ORIGINAL])
+        self.output_data[S_PROFILE] = profile
+        self.write_output_json()
+
+    def config_adaptive(self, static_threshold: float = 0.5, static_crf_offset: float = 2, static_preset: str = None,
+                        complex_threshold: float = 2, complex_crf_offset: float = 0, complex_preset: str = None):
+        """adapt crf and preset of segments below `static_threshold` or above `complex_threshold` of complexity"""
+        self.read_output_json()
+        self.output_data[S_ADAPTIVE] = {
+            'static': {'threshold': static_threshold, 'crf_offset': static_crf_offset, 'preset': static_preset},
+            'complex': {'threshold': complex_threshold, 'crf_offset': complex_crf_offset, 'preset': complex_preset}}
+        self.write_output_json()
+
+    def segment_args(self, stream_id, segment_file) -> list:
+        """output args of a segment, i.e. configured segment args adapted to its complexity, see `config_adaptive()`"""
+        args = self.output_data[S_SEGMENT]
+        policy = self.output_data.get(S_ADAPTIVE)
+        complexity = self.input_data[S_SEGMENT][stream_id][segment_file].get('complexity')
+        if not policy or complexity is None:
+            return args
+        static, busy = policy['static'], policy['complex']
+        if static['threshold'] is not None and complexity < static['threshold']:
+            adapt = static
+        elif busy['threshold'] is not None and complexity > busy['threshold']:
+            adapt = busy
+        else:
+            return args
+        args = list(args)
+        for key in ('-crf', '-global_quality'):
+            if key in args and adapt['crf_offset']:
+                i = args.index(key) + 1
+                crf = float(args[i]) + adapt['crf_offset']
+                args[i] = str(int(crf) if crf.is_integer() else crf)
+        if adapt['preset'] and '-preset' in args:
+            args[args.index('-preset') + 1] = adapt['preset']
+        return args
+
+    def predict_convert_seconds(self) -> float or None:
+        profile = self.output_data.get(S_PROFILE)
+        pixel_rate = get_profile_pixel_rate(profile) if profile else None
+        if not pixel_rate:
+            return None
+        return self.segment_table.pixels() / pixel_rate
+
+    @property
+    def segment_table(self):
+        """columnar `SegmentTable` of input segments, rebuilt after input data is written (numpy needed)"""
+        from .segment_table import SegmentTable
+        if not self._segment_table:
+            self._segment_table = SegmentTable(self.input_data[S_SEGMENT])
+        return self._segment_table
+
+    def segment_stats(self, bins: int = 20, k: float = 1.5) -> dict:
+        table = self.segment_table
+        return {stream_id: {**table.totals(stream_id),
+                            'bit_rate_histogram': table.histogram(stream_id, 'bit_rate', bins=bins),
+                            'bit_rate_outliers': table.outliers(stream_id, 'bit_rate', k=k)}
+                for stream_id in table.files}
+
+    def partition_segments(self, parts: int) -> List[List[tuple]]:
+        """split all segments into `parts` contiguous runs of about equal duration, e.g. one run per host"""
+        return self.segment_table.partition(parts)
+
     def merge(self):
         if not self.read_output_json():
             raise self.ContainerError('no output config')
-        if self.get_lock_segments() or \
-                len(self.get_done_segments()) != len(self.get_all_segments()):
+        if self.reconcile_status_journal():
             raise self.SegmentMissing
+        self.write_output_concat_list_file()
         d = self.output_data
         concat_list = []
         extra_input_list = []
@@ -661,16 +1480,91 @@ class FFmpegSegmentsContainer:
                               **d['kwargs'])
 
     def write_output_concat_list_file(self):
-        with pushd_context(self.root):
-            d = self.input_data[S_SEGMENT]
-            for index in d:
-                folder = self.output_prefix + index
-                os.makedirs(folder, exist_ok=True)
-                with pushd_context(folder):
-                    lines = ["file '{}'".format(os.path.join(folder, seg)) for seg in
-                             sorted(d[index].keys(), key=lambda x: int(os.path.splitext(x)[0]))]
-                    with ensure_open_file(self.concat_list_file, 'w') as f:
-                        f.write('\n'.join(lines))
+        d = self.input_data[S_SEGMENT]
+        for index in d:
+            folder = self.output_prefix + index
+            os.makedirs(os.path.join(self.root, folder), exist_ok=True)
+            state = self.read_progressive_state(index)
+            ordered = [os.path.join(self.segment_hash(index, f), f) for f in self.sorted_segment_files(index)]
+            if state.get('merged'):
+                files = [state['file']] + ordered[state['merged']:]
+            else:
+                files = ordered
+            lines = ["file '{}'".format(os.path.join(folder, seg)) for seg in files]
+            with ensure_open_file(os.path.join(self.root, folder, self.concat_list_file), 'w') as f:
+                f.write('\n'.join(lines))
+
+    def sorted_segment_files(self, stream_id) -> List[str]:
+        return sorted(self.input_data[S_SEGMENT][stream_id].keys(), key=lambda x: int(os.path.splitext(x)[0]))
+
+    def segment_hash(self, stream_id, segment_file) -> str:
+        """short hash of effective output args of a segment, which names its output sub-folder"""
+        if self._args_hashes is None:
+            self._args_hashes = {}
+        hashes = self._args_hashes
+        if (stream_id, segment_file) not in hashes:
+            args = self.segment_args(stream_id, segment_file)
+            hashes[stream_id, segment_file] = hex_hash(json.dumps(args).encode())[:8]
+        return hashes[stream_id, segment_file]
+
+    def segment_output_path(self, stream_id, segment_file, args_hash: str = None) -> str:
+        """o-<stream_id>/<args hash>/<segment_file>, args hash '' for the flat layout of old containers"""
+        if args_hash is None:
+            args_hash = self.segment_hash(stream_id, segment_file)
+        return os.path.join(self.root, self.output_prefix + stream_id, args_hash, segment_file)
+
+    def read_progressive_state(self, stream_id) -> dict:
+        """progressive merge state of a stream, empty if none, or merged segments were encoded with other args"""
+        state_file = os.path.join(self.root, self.output_prefix + stream_id, self.progressive_json)
+        state = read_json_file(state_file) if os.path.isfile(state_file) else {}
+        if state.get('merged') and state.get('key') != self.progressive_key(stream_id, state['merged']):
+            return {}
+        return state
+
+    def progressive_key(self, stream_id, merged: int) -> str:
+        ordered = self.sorted_segment_files(stream_id)[:merged]
+        return hex_hash('\n'.join([self.segment_hash(stream_id, f) for f in ordered]).encode())[:8]
+
+    def merge_progressive(self, min_step: int = 8):
+        """concat done prefix of segments into an intermediate file, re-merged only when it grows geometrically"""
+        done = set(self.get_done_segments())
+        for index in self.input_data[S_SEGMENT]:
+            folder = os.path.join(self.root, self.output_prefix + index)
+            state_file = os.path.join(folder, self.progressive_json)
+            lock = state_file + self.suffix_lock
+            if not self.file_lock.acquire(lock):
+                continue
+            try:
+                state = self.read_progressive_state(index)
+                merged = state.get('merged', 0)
+                ordered = self.sorted_segment_files(index)
+                end = merged
+                while end < len(ordered) and (index, ordered[end]) in done:
+                    end += 1
+                if end == merged or (end - merged < max(min_step, merged) and end < len(ordered)):
+                    continue
+                inputs = ([os.path.join(folder, state['file'])] if merged else []) + [
+                    self.segment_output_path(index, f) for f in ordered[merged:end]]
+                key = self.progressive_key(index, end)
+                output = 'prefix-{}-{}.mkv'.format(end, key)
+                self.new_ffcmd().concat(inputs, os.path.join(folder, output))
+                old_state = read_json_file(state_file) if os.path.isfile(state_file) else {}
+                write_json_file(state_file, {'merged': end, 'file': output, 'key': key})
+                if old_state.get('file') and os.path.isfile(os.path.join(folder, old_state['file'])):
+                    os.remove(os.path.join(folder, old_state['file']))
+                self.logger.info('progressively merged {} segments of stream {}'.format(end, index))
+            finally:
+                self.file_lock.release(lock)
+
+    def clear_progressive(self):
+        for index in self.input_data[S_SEGMENT]:
+            folder = os.path.join(self.root, self.output_prefix + index)
+            state_file = os.path.join(folder, self.progressive_json)
+            if os.path.isfile(state_file):
+                state = read_json_file(state_file)
+                if state.get('file') and os.path.isfile(os.path.join(folder, state['file'])):
+                    os.remove(os.path.join(folder, state['file']))
+                os.remove(state_file)
 
     def file_has_lock(self, filepath):
         return os.path.isfile(filepath + self.suffix_lock)
@@ -688,164 +1582,462 @@ class FFmpegSegmentsContainer:
         return segments
 
     def get_untouched_segments(self):
-        all_segments = self.get_all_segments()
-        lock_segments = self.get_lock_segments()
-        done_segments = self.get_done_segments()
-        return remove_from_list(remove_from_list(all_segments, lock_segments), done_segments)
+        index = self.read_status_journal()
+        return [(i, f) for i, f in self.get_all_segments() if self.segment_hash(i, f) not in index.get((i, f), {})]
 
     def get_lock_segments(self):
+        return self.get_segments_of_state(S_LOCK)
+
+    def get_segments_of_state(self, state: str) -> list:
+        return [(i, f) for (i, f), states in self.read_status_journal().items()
+                if states.get(self.segment_hash(i, f)) == state]
+
+    def get_stale_lock_segments(self):
+        """locked segments whose lock lease expired (e.g. the worker holding them crashed), or lock file missing"""
         segments = []
-        prefix = self.output_prefix
-        with pushd_context(self.root):
-            for index in self.input_data[S_SEGMENT]:
-                with pushd_context(prefix + index):
-                    segments.extend([(index, f.rstrip(self.suffix_lock)) for f in
-                                     fs_find_iter('*' + self.suffix_lock)])
+        for i, f in self.get_lock_segments():
+            lock = self.segment_output_path(i, f) + self.suffix_lock
+            if not os.path.isfile(lock) or self.file_lock.is_stale(lock):
+                segments.append((i, f))
         return segments
 
     def get_done_segments(self):
+        return self.get_segments_of_state(S_DONE)
+
+    def scan_segments(self, suffix: str) -> list:
+        """find (stream_id, segment_file, args_hash) of segments with tag file of `suffix` by walking output folders"""
         segments = []
-        prefix = self.output_prefix
-        with pushd_context(self.root):
-            for index in self.input_data[S_SEGMENT]:
-                with pushd_context(prefix + index):
-                    segments.extend([(index, f.rstrip(self.suffix_done)) for f in
-                                     fs_find_iter('*' + self.suffix_done)])
+        for index in self.input_data[S_SEGMENT]:
+            for f in fs_find_iter('*' + suffix, root=os.path.join(self.root, self.output_prefix + index)):
+                args_hash, name = os.path.split(f[:-len(suffix)])
+                if re.match(self.segment_filename_regex_pattern, name):
+                    segments.append((index, name, args_hash))
         return segments
 
-    def convert(self, overwrite: bool = False):
+    def journal_status(self, stream_id, segment_file, state: str, args_hash: str = None):
+        if args_hash is None:
+            args_hash = self.segment_hash(stream_id, segment_file)
+        line = '{}\t{}\t{}\t{}\n'.format(state, stream_id, segment_file, args_hash).encode('utf8')
+        fd = os.open(os.path.join(self.root, self.status_journal), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def read_status_journal(self) -> dict:
+        """{(stream_id, segment_file): {args_hash: state}}, updated with new lines of status journal"""
+        journal = os.path.join(self.root, self.status_journal)
+        with self.status_lock:
+            if not os.path.isfile(journal):
+                self.rebuild_status_journal()
+            with open(journal, 'rb') as f:
+                f.seek(self.status_offset)
+                data = f.read()
+            end = data.rfind(b'\n') + 1  # skip incomplete line being written by others
+            self.status_offset += end
+            for line in data[:end].decode('utf8').splitlines():
+                state, stream_id, segment_file, args_hash = (line.split('\t') + [''])[:4]
+                states = self.status_index.setdefault((stream_id, segment_file), {})
+                if state in (S_LOCK, S_DONE):
+                    states[args_hash] = state
+                else:
+                    states.pop(args_hash, None)
+            return self.status_index
+
+    def adopt_flat_segment(self, stream_id, segment_file) -> str:
+        """move a done segment of the flat layout into the folder of current args hash, return its args hash"""
+        if not self.output_data:
+            self.read_output_json()
+        flat = self.segment_output_path(stream_id, segment_file, args_hash='')
+        dst = self.segment_output_path(stream_id, segment_file)
+        if not os.path.isfile(flat) or os.path.exists(dst) or os.path.exists(dst + self.suffix_done):
+            return ''
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.replace(flat, dst)
+        os.replace(flat + self.suffix_done, dst + self.suffix_done)
+        self.logger.info('adopt {} into {}'.format(flat, dst))
+        return self.segment_hash(stream_id, segment_file)
+
+    def reconcile_status_journal(self) -> list:
+        """journal done segments whose done line is lost (e.g. by append over NFS), return segments not done"""
+        missing = []
+        index = self.read_status_journal()
+        for i, f in self.get_all_segments():
+            if index.get((i, f), {}).get(self.segment_hash(i, f)) == S_DONE:
+                continue
+            if self.file_has_done(self.segment_output_path(i, f)):
+                self.logger.warning('journal missing done segment: {}'.format(os.path.join(i, f)))
+                self.journal_status(i, f, S_DONE)
+            else:
+                missing.append((i, f))
+        return missing
+
+    def rebuild_status_journal(self):
+        journal = os.path.join(self.root, self.status_journal)
+        lines = ['{}\t{}\t{}\t{}\n'.format(S_LOCK, *x) for x in self.scan_segments(self.suffix_lock)]
+        for i, f, args_hash in self.scan_segments(self.suffix_done):
+            if not args_hash:
+                args_hash = self.adopt_flat_segment(i, f)
+            lines.append('{}\t{}\t{}\t{}\n'.format(S_DONE, i, f, args_hash))
+        with open(journal + '.tmp', 'w', encoding='utf8') as f:
+            f.writelines(lines)
+        os.replace(journal + '.tmp', journal)
+        self.status_index = {}
+        self.status_offset = 0
+
+    def convert(self, overwrite: bool = False, workers: int = 1, cpu_budget: int = None,
+                progressive_merge: bool = False):
         if overwrite:
-            def get_segments():
-                return self.get_all_segments()
+            segments = self.get_all_segments()
         else:
-            def get_segments():
-                return self.get_untouched_segments()
-        segments = get_segments()
-        while segments:
-            # stream_id, segment_file = random.choice(segments)
-            stream_id, segment_file = segments.pop(0)
-            self.convert_one_segment(stream_id, segment_file, overwrite=overwrite)
-
-    def nap(self):
-        t = round(random.uniform(0.2, 0.4), 3)
-        self.logger.debug('sleep {}s'.format(t))
-        sleep(t)
-
-    def file_tag_lock(self, filepath):
-        if self.file_has_lock(filepath) or self.file_has_done(filepath):
+            segments = self.get_untouched_segments() + self.get_stale_lock_segments()
+        if workers <= 0:
+            workers = self.auto_workers(cpu_budget)
+        if workers == 1:
+            while segments:
+                # stream_id, segment_file = random.choice(segments)
+                stream_id, segment_file = segments.pop(0)
+                try:
+                    self.convert_one_segment(stream_id, segment_file, overwrite=overwrite)
+                except self.SegmentLockedError:
+                    self.logger.info('skip locked segment {}'.format(os.path.join(stream_id, segment_file)))
+                except self.SegmentDeleteRequest:
+                    pass
+                if progressive_merge:
+                    self.merge_progressive()
+            self.save_probe_cache()
+            self.collect_telemetry()
             return
-        else:
-            fs_touch(filepath + self.suffix_lock)
+        lock = Lock()
+
+        def worker():
+            ffcmd = self.new_ffcmd()
+            while True:
+                with lock:
+                    if not segments:
+                        return
+                    stream_id, segment_file = segments.pop(0)
+                try:
+                    self.convert_one_segment(stream_id, segment_file, overwrite=overwrite, ffcmd=ffcmd)
+                except self.SegmentLockedError:
+                    self.logger.info('skip locked segment {}'.format(os.path.join(stream_id, segment_file)))
+                except self.SegmentDeleteRequest:
+                    pass
+                if progressive_merge:
+                    self.merge_progressive()
+
+        self.logger.info('convert with {} workers'.format(workers))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(worker) for _ in range(workers)]
+        self.save_probe_cache()
+        self.collect_telemetry()
+        for f in futures:
+            f.result()
+
+    def work(self, workers: int = 1, cpu_budget: int = None, poll_interval: float = 10, merge: bool = False):
+        """keep converting until all segments are done, sharing the container with other hosts"""
+        while True:
+            self.convert(workers=workers, cpu_budget=cpu_budget)
+            if len(self.get_done_segments()) == len(self.get_all_segments()):
+                break
+            self.logger.info('wait {}s for segments locked by other workers'.format(poll_interval))
+            sleep(poll_interval)
+        if merge:
+            merge_lock = os.path.join(self.root, self.output_filename_prefix + self.suffix_lock)
+            merge_done = os.path.join(self.root, self.output_filename_prefix + self.suffix_done)
+            if self.file_lock.acquire(merge_lock):
+                try:
+                    key = self.merge_key()
+                    if os.path.isfile(merge_done) and read_json_file(merge_done).get('key') == key:
+                        self.logger.info('already merged: {}'.format(self.output_data[S_FILENAME]))
+                        return
+                    self.merge()
+                    write_json_file(merge_done, {'key': key, 'host': self.file_lock.owner,
+                                                 'end_time': round(time(), 3)})
+                finally:
+                    self.file_lock.release(merge_lock)
+
+    def merge_key(self) -> str:
+        """short hash of merge output config and args hashes of all segments, see `work()`"""
+        d = self.output_data
+        hashes = [self.segment_hash(i, f) for i, f in self.get_all_segments()]
+        return hex_hash(json.dumps([d[S_VIDEO], d[S_OTHER], d[S_MORE], d[S_FILENAME], d['kwargs'],
+                                    hashes]).encode())[:8]
+
+    def new_ffcmd(self) -> FFmpegCaller:
+        return FFmpegCaller(banner=False, loglevel='warning', overwrite=True, capture_out_err=True, progress=True)
+
+    def get_segment_threads(self) -> int:
+        args = self.output_data[S_SEGMENT]
+        try:
+            return int(args[args.index('-threads') + 1])
+        except (ValueError, IndexError):
+            return 0
+
+    def auto_workers(self, cpu_budget: int = None) -> int:
+        cpu_budget = cpu_budget or os.cpu_count() or 1
+        threads = self.get_segment_threads() or self.default_threads_per_job
+        return max(cpu_budget // threads, 1)
+
+    def file_tag_lock(self, filepath) -> bool:
+        """atomically acquire the lock of a segment, return False if it is locked by others"""
+        if self.file_has_done(filepath):
+            return False
+        return self.file_lock.acquire(filepath + self.suffix_lock)
 
     def file_tag_unlock(self, filepath):
-        if self.file_has_lock(filepath):
-            os.remove(filepath + self.suffix_lock)
+        self.file_lock.release(filepath + self.suffix_lock)
 
     def file_tag_done(self, filepath):
         if self.file_has_done(filepath):
             return
-        if self.file_has_lock(filepath):
-            fs_rename(filepath + self.suffix_lock, filepath + self.suffix_done,
-                      stay_in_src_dir=False, append_src_ext=False)
+        lock = filepath + self.suffix_lock
+        if self.file_lock.owner_of(lock) == self.file_lock.owner:
+            os.replace(lock, filepath + self.suffix_done)
+            self.file_lock.release(lock, remove_file=False)
 
     def file_tag_delete(self, filepath):
         fs_touch(filepath + self.suffix_delete)
 
-    def convert_one_segment(self, stream_id, segment_file, overwrite=False) -> dict:
-        segment_path_no_prefix = os.path.join(stream_id, segment_file)
-        i_seg = self.input_prefix + segment_path_no_prefix
-        o_seg = self.output_prefix + segment_path_no_prefix
-        args = self.output_data[S_SEGMENT]
-        with pushd_context(self.root):
-            self.nap()
-            if self.file_has_lock(o_seg):
-                raise self.SegmentLockedError
-            if not overwrite and self.file_has_done(o_seg):
+    def convert_one_segment(self, stream_id, segment_file, overwrite=False, ffcmd: FFmpegCaller = None) -> dict:
+        # absolute paths instead of `pushd_context`, since cwd is shared among worker threads
+        i_seg = os.path.join(self.root, self.input_prefix + stream_id, segment_file)
+        o_seg = self.segment_output_path(stream_id, segment_file)
+        os.makedirs(os.path.dirname(o_seg), exist_ok=True)
+        args = self.segment_args(stream_id, segment_file)
+        ffcmd = ffcmd or self.ffcmd
+        if not overwrite and self.file_has_done(o_seg):
+            if self.read_status_journal().get((stream_id, segment_file), {}).get(
+                    self.segment_hash(stream_id, segment_file)) != S_DONE:
+                self.journal_status(stream_id, segment_file, S_DONE)
+            return self.get_done_segment_info(filepath=o_seg)
+        if overwrite and self.file_has_done(o_seg):
+            os.remove(o_seg + self.suffix_done)
+            self.journal_status(stream_id, segment_file, S_UNLOCK)
+        if not self.file_tag_lock(o_seg):
+            raise self.SegmentLockedError
+        self.journal_status(stream_id, segment_file, S_LOCK)
+        ffcmd.progress_duration = self.input_data[S_SEGMENT][stream_id][segment_file].get('duration')
+        ffcmd.progress_callback = self.progress_callback and (
+            lambda progress: self.progress_callback(stream_id, segment_file, progress))
+        ffcmd.stall_timeout = self.stall_timeout
+        try:
+            saved_error = None
+            ffcmd.last_progress = None
+            t0 = time()
+            ffcmd.convert([i_seg], o_seg, args)
+            wall_time = round(time() - t0, 3)
+            if self.file_has_delete(o_seg):
+                self.logger.info('delete {}'.format(o_seg))
+                os.remove(o_seg)
+                os.remove(o_seg + self.suffix_delete)
+                raise self.SegmentDeleteRequest
+            else:
+                self.file_tag_done(o_seg)
+                self.journal_status(stream_id, segment_file, S_DONE)
+                self.write_segment_telemetry(o_seg, wall_time, ffcmd.last_progress)
                 return self.get_done_segment_info(filepath=o_seg)
-            self.file_tag_lock(o_seg)
-            try:
-                saved_error = None
-                self.ffcmd.convert([i_seg], o_seg, args)
-                self.nap()
-                if self.file_has_delete(o_seg):
-                    self.logger.info('delete {}'.format(o_seg))
-                    os.remove(o_seg)
-                    raise self.SegmentDeleteRequest
-                else:
-                    self.file_tag_done(o_seg)
-                    return self.get_done_segment_info(filepath=o_seg)
-            except Exception as e:
-                saved_error = e
-            finally:
-                self.file_tag_unlock(o_seg)
-                if saved_error:
-                    raise saved_error
+        except Exception as e:
+            saved_error = e
+        finally:
+            self.file_tag_unlock(o_seg)
+            if saved_error:
+                self.journal_status(stream_id, segment_file, S_UNLOCK)
+                raise saved_error
+
+    def write_segment_telemetry(self, filepath, wall_time: float, progress: dict = None):
+        d = {'wall_time': wall_time, 'host': self.file_lock.owner, 'end_time': round(time(), 3)}
+        if progress:
+            d.update({k: progress[k] for k in ('frame', 'fps', 'bitrate', 'speed')})
+        if self.file_has_done(filepath):
+            write_json_file(filepath + self.suffix_done, d)
+
+    def collect_telemetry(self) -> dict:
+        d = {}
+        for stream_id, segment_file in self.get_done_segments():
+            done_tag = self.segment_output_path(stream_id, segment_file) + self.suffix_done
+            if os.path.isfile(done_tag) and os.path.getsize(done_tag):
+                d.setdefault(stream_id, {})[segment_file] = read_json_file(done_tag)
+        self.output_data = self.read_output_json()
+        self.output_data[S_TELEMETRY] = d
+        self.write_output_json()
+        return d
 
     def get_done_segment_info(self, stream_id=None, segment_filename=None, filepath=None) -> dict:
         if filepath:
-            o_seg = filepath
+            o_seg = os.path.join(self.root, filepath)
         else:
-            o_seg = os.path.join(self.output_prefix + stream_id, segment_filename)
-        with pushd_context(self.root):
-            if not self.file_has_done(o_seg):
-                raise self.SegmentNotDoneError
-            return excerpt_single_video_stream(o_seg)
-
-    def estimate(self, overwrite=True) -> dict:
-        d = {}
+            o_seg = self.segment_output_path(stream_id, segment_filename)
+        if not self.file_has_done(o_seg):
+            raise self.SegmentNotDoneError
+        return excerpt_single_video_stream(o_seg)
+
+    def estimate(self, samples: int = 8, workers: int = 0, sample_seconds: float = None,
+                 overwrite: bool = False) -> dict:
+        """estimate output/input size ratio of each video stream, by encoding stratified sample segments"""
+        if workers <= 0:
+            workers = self.auto_workers()
+        test_data = read_json_file(os.path.join(self.root, self.test_json))
+        args_key = hex_hash(json.dumps([self.output_data[S_SEGMENT], sample_seconds]).encode())[:8]
+        sample_cache = test_data.setdefault('samples', {}).setdefault(args_key, {})
         segments = self.input_data[S_SEGMENT]
+        table = self.segment_table
+        d = {}
+
+        def encode(stream_id, segment_file):
+            if not sample_seconds:
+                return self.convert_one_segment(stream_id, segment_file, overwrite=overwrite, ffcmd=self.new_ffcmd())
+            cached = sample_cache.get(stream_id, {}).get(segment_file)
+            if cached and not overwrite:
+                return cached
+            return self.encode_sample(stream_id, segment_file, self.output_data[S_SEGMENT], sample_seconds)[-1]
+
         for stream_id in segments:
-            d[stream_id] = sd = {}
-            segments_sorted_by_rate = sorted([(k, v) for k, v in segments[stream_id].items() if v['duration'] >= 1],
-                                             key=lambda x: x[-1]['bit_rate'])
-            min_rate_seg_f, min_rate_seg_d = segments_sorted_by_rate[0]
-            max_rate_seg_f, max_rate_seg_d = segments_sorted_by_rate[-1]
-            sd['min'] = {'file': min_rate_seg_f, 'input': min_rate_seg_d,
-                         'output': self.convert_one_segment(stream_id, min_rate_seg_f,
-                                                            overwrite=overwrite)}
-            sd['max'] = {'file': max_rate_seg_f, 'input': max_rate_seg_d,
-                         'output': self.convert_one_segment(stream_id, max_rate_seg_f,
-                                                            overwrite=overwrite)}
-            sd['min']['ratio'] = round(sd['min']['output']['bit_rate'] / sd['min']['input']['bit_rate'], 3)
-            sd['max']['ratio'] = round(sd['max']['output']['bit_rate'] / sd['max']['input']['bit_rate'], 3)
-
-            k = (sd['max']['output']['bit_rate'] - sd['min']['output']['bit_rate']) / (
-                    sd['max']['input']['bit_rate'] - sd['min']['input']['bit_rate'])
-
-            def linear_estimate(input_bit_rate):
-                return k * (input_bit_rate - sd['min']['input']['bit_rate']) + sd['min']['output']['bit_rate']
-
-            total_duration = 0
-            total_input_size = 0
-            estimated_output_size = 0
-            for seg_d in segments[stream_id].values():
-                estimated_bit_rate = linear_estimate(seg_d['bit_rate'])
-                duration = seg_d['duration']
-                total_duration += duration
-                total_input_size += seg_d['size']
-                estimated_output_size += duration * estimated_bit_rate // 8
-            sd['estimate'] = {'type': 'linear',
+            picked = self.pick_sample_segments(stream_id, samples)
+            if not picked:
+                continue
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                outputs = list(pool.map(lambda x: encode(stream_id, x[0]), picked))
+            if sample_seconds:
+                sample_cache[stream_id] = {**sample_cache.get(stream_id, {}),
+                                           **{f: o for (f, _), o in zip(picked, outputs)}}
+            xs = [i['bit_rate'] for _, i in picked]
+            ys = [o['bit_rate'] for o in outputs]
+            fit = linear_regression(xs, ys)
+            sd = d[stream_id] = {'samples': [{'file': f, 'input': i, 'output': o,
+                                              'ratio': round(o['bit_rate'] / i['bit_rate'], 3)}
+                                             for (f, i), o in zip(picked, outputs)],
+                                 'fit': fit}
+
+            # estimated size = sum(w * (a + b * x)), with w = duration / 8
+            sum_w, sum_wx = table.weighted_sums(stream_id)
+            totals = table.totals(stream_id)
+            total_duration, total_input_size = totals['duration'], totals['size']
+            estimated_output_size = fit['a'] * sum_w + fit['b'] * sum_wx
+            sd['estimate'] = {'type': 'linear regression',
                               'size': int(estimated_output_size),
                               'duration': total_duration,
                               'bit_rate': 8 * estimated_output_size // total_duration,
                               'ratio': round(estimated_output_size / total_input_size, 3)}
-
-        with pushd_context(self.root):
-            write_json_file(self.test_json, d, indent=4)
+            if fit['var_a'] is not None:
+                var = sum_w ** 2 * fit['var_a'] + sum_wx ** 2 * fit['var_b'] + 2 * sum_w * sum_wx * fit['cov_ab']
+                half_width = 1.96 * max(var, 0) ** 0.5
+                sd['estimate']['ratio_ci95'] = [round((estimated_output_size - half_width) / total_input_size, 3),
+                                                round((estimated_output_size + half_width) / total_input_size, 3)]
+
+        test_data.update(d)
+        write_json_file(os.path.join(self.root, self.test_json), test_data, indent=4)
         return {k: v['estimate']['ratio'] for k, v in d.items()}
 
+    def pick_sample_segments(self, stream_id, samples: int) -> List[tuple]:
+        segments = self.input_data[S_SEGMENT][stream_id]
+        return [(f, segments[f]) for f in self.segment_table.stratified_sample(stream_id, samples)]
+
+    def encode_sample(self, stream_id, segment_file, args, sample_seconds: float = None,
+                      name_prefix: str = '') -> tuple:
+        i_seg = os.path.join(self.root, self.input_prefix + stream_id, segment_file)
+        t_seg = os.path.join(self.root, self.test_prefix + stream_id, name_prefix + segment_file)
+        os.makedirs(os.path.dirname(t_seg), exist_ok=True)
+        self.new_ffcmd().convert([i_seg], t_seg, args, end=sample_seconds or 0)
+        return t_seg, excerpt_single_video_stream(t_seg)
+
+    def auto_crf(self, target_ratio: float = None, target_ssim: float = None, target_vmaf: float = None,
+                 crf_range: tuple = (16, 40), samples: int = 4, sample_seconds: float = 10, workers: int = 0,
+                 strict: bool = False) -> int:
+        """binary search crf on sampled segments meeting one target, then config it into output json"""
+        targets = [x for x in (target_ratio, target_ssim, target_vmaf) if x is not None]
+        if len(targets) != 1:
+            raise ValueError('exactly one of target_ratio, target_ssim, target_vmaf is required')
+        metric = 'ssim' if target_ssim is not None else 'vmaf' if target_vmaf is not None else None
+        if workers <= 0:
+            workers = self.auto_workers()
+        picked = [(stream_id, f, i) for stream_id in self.input_data[S_SEGMENT]
+                  for f, i in self.pick_sample_segments(stream_id, samples)]
+        base_args = self.output_data[S_SEGMENT]
+        tried = {}
+        sample_files = []
+
+        def try_crf(crf: int) -> dict:
+            args = replace_crf(base_args, crf)
+
+            def encode(x):
+                stream_id, f, i = x
+                t_seg, o = self.encode_sample(stream_id, f, args, sample_seconds, name_prefix='crf{}_'.format(crf))
+                sample_files.append(t_seg)
+                i_seg = os.path.join(self.root, self.input_prefix + stream_id, f)
+                score = measure_quality(t_seg, i_seg, metric, duration=sample_seconds) if metric else None
+                return i['bit_rate'], o['bit_rate'], score
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(encode, picked))
+            r = {'ratio': round(sum([o for _, o, _ in results]) / sum([i for i, _, _ in results]), 3)}
+            if metric:
+                r[metric] = round(sum([q for _, _, q in results]) / len(results), 4)
+            self.logger.info('crf {}: {}'.format(crf, r))
+            tried[crf] = r
+            return r
+
+        def ok(crf: int) -> bool:
+            r = tried[crf] if crf in tried else try_crf(crf)
+            return r['ratio'] <= target_ratio if metric is None else r[metric] >= targets[0]
+
+        low, high = crf_range
+        met = False
+        try:
+            if metric is None:  # size shrinks as crf grows, find the lowest ok crf
+                best = high
+                while low <= high:
+                    mid = (low + high) // 2
+                    if ok(mid):
+                        best, high, met = mid, mid - 1, True
+                    else:
+                        low = mid + 1
+            else:  # quality drops as crf grows, find the highest ok crf
+                best = low
+                while low <= high:
+                    mid = (low + high) // 2
+                    if ok(mid):
+                        best, low, met = mid, mid + 1, True
+                    else:
+                        high = mid - 1
+        finally:
+            for f in sample_files:
+                if os.path.isfile(f):
+                    os.remove(f)
+        if not met:
+            msg = 'no crf in {} meets target {}, tried: {}'.format(crf_range, targets[0], tried)
+            if strict:
+                raise self.ContainerError(msg)
+            self.logger.warning('{}, fallback to crf {}'.format(msg, best))
+
+        conf = self.read_output_json()
+        conf[S_ORIGINAL]['video_args'] = replace_crf(conf[S_ORIGINAL]['video_args'] or [], best)
+        self.config(**conf[S_ORIGINAL])
+        self.output_data[S_AUTO_CRF] = {'crf': best, 'met': met,
+                                        'target': {'ratio': target_ratio, 'ssim': target_ssim, 'vmaf': target_vmaf},
+                                        'tried': {str(k): v for k, v in sorted(tried.items())}}
+        self.write_output_json()
+        return best
+
     def clear(self):
+        """delete output segments of current args, outputs of other args are kept, see `clear_other_args()`"""
+        self.clear_progressive()
         with pushd_context(self.root):
             segments = self.get_lock_segments() + self.get_done_segments()
             while segments:
                 for i, seg in segments:
-                    o_seg = os.path.join(self.output_prefix + i, seg)
+                    o_seg = self.segment_output_path(i, seg)
                     if not os.path.isfile(o_seg):
+                        if not self.file_has_lock(o_seg):
+                            if self.file_has_done(o_seg):
+                                os.remove(o_seg + self.suffix_done)
+                            self.journal_status(i, seg, S_UNLOCK)
                         continue
                     elif self.file_has_done(o_seg):
                         self.logger.info('delete done segment {}'.format(o_seg))
                         os.remove(o_seg)
                         os.remove(o_seg + self.suffix_done)
+                        self.journal_status(i, seg, S_UNLOCK)
                     elif self.file_has_lock(o_seg):
                         self.logger.info('request delete locked segment {}'.format(o_seg))
                         fs_touch(o_seg + self.suffix_delete)
@@ -854,7 +2046,25 @@ class FFmpegSegmentsContainer:
                         os.remove(o_seg)
                         if self.file_has_delete(o_seg):
                             os.remove(o_seg + self.suffix_delete)
+                        self.journal_status(i, seg, S_UNLOCK)
                 segments = self.get_lock_segments() + self.get_done_segments()
+                if segments:
+                    sleep(1)
+
+    def clear_other_args(self):
+        """delete done output segments encoded with args other than current ones, to reclaim disk space"""
+        for i, seg, args_hash in self.scan_segments(self.suffix_done):
+            if args_hash == self.segment_hash(i, seg):
+                continue
+            o_seg = self.segment_output_path(i, seg, args_hash)
+            self.logger.info('delete done segment of other args {}'.format(o_seg))
+            if os.path.isfile(o_seg):
+                os.remove(o_seg)
+            os.remove(o_seg + self.suffix_done)
+            self.journal_status(i, seg, S_UNLOCK, args_hash)
+            folder = os.path.dirname(o_seg)
+            if args_hash and not os.listdir(folder):
+                os.rmdir(folder)
 
     def vf_scale_down_res(self, within='FHD'):
         height, width = self.width_height
@@ -870,6 +2080,169 @@ class FFmpegSegmentsContainer:
         return height, width
 
 
+def split_container_root(path: str, work_dir: str = None, **kwargs) -> str:
+    return FFmpegSegmentsContainer(path, work_dir=work_dir, **kwargs).root
+
+
+def merge_container_root(root: str) -> str:
+    FFmpegSegmentsContainer(root).merge()
+    return root
+
+
+class FFmpegSegmentsContainerBatch:
+    """convert all videos in directory tree(s), segments of all containers fed into one worker pool"""
+    nickname = 'ffsegbatch'
+    logger = get_logger('.'.join((__name__, nickname)))
+
+    def __init__(self, workers: int = 0, cpu_budget: int = None, max_splits: int = 2, work_dir: str = None,
+                 priority: Callable = None, config_func: Callable = None, merge: bool = True, profile: str = None,
+                 **container_kwargs):
+        cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.workers = workers if workers > 0 else max(cpu_budget // FFmpegSegmentsContainer.default_threads_per_job, 1)
+        self.max_splits = max_splits
+        self.work_dir = work_dir
+        self.priority = priority or self.predicted_seconds
+        self.config_func = config_func
+        self.profile = profile
+        self.merge = merge
+        self.container_kwargs = container_kwargs
+        self.failed = []
+        self.unmerged = []
+        self._queue = []
+        self._pending = {}  # container root -> number of queued segments not finished
+        self._locked = {}  # container root -> segments skipped since locked by others
+        self._broken = set()  # roots of containers with failed segment, never merged
+        self._merges = []
+        self._procs = None
+        self._cond = Condition()
+        self._feeding = False
+        self._seq = 0
+
+    @classmethod
+    def predicted_seconds(cls, container: FFmpegSegmentsContainer) -> float:
+        t = container.predict_convert_seconds()
+        return cls.total_duration(container) if t is None else t
+
+    @staticmethod
+    def total_duration(container: FFmpegSegmentsContainer) -> float:
+        return sum([v['duration'] for d in container.input_data[S_SEGMENT].values() for v in d.values()])
+
+    @staticmethod
+    def scan(*paths, recursive: bool = True) -> List[str]:
+        found = []
+        for path in paths:
+            if os.path.isfile(path):
+                found.append(os.path.abspath(path))
+                continue
+            for parent, folders, files in os.walk(path):
+                containers = [f for f in folders if f.startswith('.' + FFmpegSegmentsContainer.nickname + '-')]
+                folders[:] = [f for f in folders if f not in containers] if recursive else []
+                for f in files:
+                    fp = os.path.abspath(os.path.join(parent, f))
+                    try:
+                        kind = os.path.isfile(fp) and filetype.guess(sniff_header(fp))
+                    except (OSError, ValueError):
+                        continue
+                    if kind and kind.mime.startswith('video'):
+                        found.append(fp)
+        return found
+
+    def run(self, *paths, recursive: bool = True):
+        files = self.scan(*paths, recursive=recursive)
+        self.logger.info('{} videos, {} workers, {} splits at most'.format(len(files), self.workers, self.max_splits))
+        self._feeding = True
+        threads = [Thread(target=self.worker) for _ in range(self.workers)]
+        for t in threads:
+            t.start()
+        spawn = multiprocessing.get_context('spawn')  # forking after threads started may copy locks held by them
+        with ProcessPoolExecutor(max_workers=self.max_splits, mp_context=spawn) as procs:
+            self._procs = procs
+            futures = [procs.submit(split_container_root, f, self.work_dir, **self.container_kwargs) for f in files]
+            try:
+                for f in as_completed(futures):
+                    try:
+                        container = FFmpegSegmentsContainer(f.result())
+                    except Exception as e:
+                        self.logger.error(repr(e))
+                        self.failed.append(e)
+                        continue
+                    if self.profile:
+                        container.config_profile(self.profile)
+                    if self.config_func:
+                        self.config_func(container)
+                    self.put(container)
+            finally:
+                with self._cond:
+                    self._feeding = False
+                    self._cond.notify_all()
+            for t in threads:
+                t.join()
+            for f in as_completed(self._merges):
+                try:
+                    self.logger.info('merged {}'.format(f.result()))
+                except Exception as e:
+                    self.logger.error(repr(e))
+                    self.failed.append(e)
+        return self.failed
+
+    def put(self, container: FFmpegSegmentsContainer):
+        segments = container.get_untouched_segments() + container.get_stale_lock_segments()
+        key = self.priority(container)
+        with self._cond:
+            self._pending[container.root] = len(segments)
+            for stream_id, segment_file in segments:
+                self._seq += 1
+                heapq.heappush(self._queue, (key, self._seq, container, stream_id, segment_file))
+            self._cond.notify_all()
+        if not segments:
+            self.finish(container)
+
+    def finish(self, container: FFmpegSegmentsContainer):
+        """called once all queued segments of a container are finished, submit its merge if it is complete"""
+        container.collect_telemetry()
+        container.release_probe_cache()
+        root = container.root
+        if root in self._broken:
+            return
+        locked = self._locked.get(root, [])
+        undone = len(container.reconcile_status_journal())
+        if locked or undone:
+            self.logger.warning('not merged, {} segments not done ({} locked by others): {}'.format(
+                undone, len(locked), root))
+            self.unmerged.append(root)
+        elif self.merge:
+            with self._cond:
+                self._merges.append(self._procs.submit(merge_container_root, root))
+
+    def worker(self):
+        ffcmd = None
+        while True:
+            with self._cond:
+                while not self._queue and self._feeding:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                _, _, container, stream_id, segment_file = heapq.heappop(self._queue)
+            ffcmd = ffcmd or container.new_ffcmd()
+            root = container.root
+            try:
+                container.convert_one_segment(stream_id, segment_file, ffcmd=ffcmd)
+            except container.SegmentLockedError:
+                self.logger.info('skip locked segment {}'.format(os.path.join(root, stream_id, segment_file)))
+                with self._cond:
+                    self._locked.setdefault(root, []).append((stream_id, segment_file))
+            except Exception as e:
+                self.logger.error('{}: {}'.format(os.path.join(root, stream_id, segment_file), repr(e)))
+                self.failed.append(e)
+                with self._cond:
+                    self._broken.add(root)
+            with self._cond:
+                self._pending[root] -= 1
+                last = self._pending[root] == 0
+            if last:
+                self.finish(container)
+
+
 def make_ffmpeg_vf_scale_down_res(width: int, height: int, within='FHD'):
     """generate 'scale=<w>:<h>' value for ffmpeg `vf` option, to scale down the given resolution
     return empty str if the given resolution is enough low thus scaling is not needed"""
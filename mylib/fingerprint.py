@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# encoding=utf8
+import mmap
+import os
+from functools import lru_cache
+from typing import Tuple
+
+from .tricks import hex_hash
+
+SNIFF_SIZE = 8192  # bytes read by `filetype` to guess file type
+SLICE_SIZE = 4096
+MEMO_SIZE = 256
+
+
+def sniff_header(filepath: str) -> bytes:
+    """leading bytes of a file, enough for `filetype.guess`"""
+    with open(filepath, 'rb') as f:
+        return f.read(SNIFF_SIZE)
+
+
+def file_fingerprint(filepath: str, algorithm: str = 'md5') -> Tuple[str, bytes]:
+    """hash of head, middle and tail slices of a file, and its sniffed header (for `filetype.guess`)
+
+    the file is mmap-ed so only the touched pages are read, result is memoized by (path, size, mtime),
+    slices are kept the same as `FFmpegSegmentsContainer` has ever used, so existing container names stay valid"""
+    filepath = os.path.abspath(filepath)
+    st = os.stat(filepath)
+    return _fingerprint(filepath, st.st_size, st.st_mtime_ns, algorithm)
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def _fingerprint(filepath: str, size: int, mtime_ns: int, algorithm: str) -> Tuple[str, bytes]:
+    if size:
+        with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            middle = size // 2
+            header = m[:SNIFF_SIZE]
+            data = m[:SLICE_SIZE] + m[max(middle - SLICE_SIZE // 2, 0):middle + SLICE_SIZE // 2] + \
+                m[max(size - SLICE_SIZE, 0):]
+    else:
+        header = data = b''
+    return hex_hash(data, algorithm), header
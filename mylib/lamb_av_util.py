@@ -3,17 +3,30 @@
 """Some FFmpeg commands"""
 
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import ffmpeg
 
 VIDEO_FILE_EXTENSIONS = ['.mp4', '.m4v', '.mkv', '.flv', '.webm']
 
 
+TAG_ORIGIN = '__origin__'
+TAG_HEVC8B = 'hevc8b'
+
+
+def hevc8b_beats_origin(origin_size: int, hevc8b_size: int) -> bool:
+    """True if the hevc8b variant is small enough to replace its origin, else the origin is kept"""
+    ratio = hevc8b_size / origin_size
+    diff = origin_size - hevc8b_size
+    return ratio <= 0.66 or ratio <= 0.75 and diff >= 50000000
+
+
 def choose_between_origin_and_hevc8b(file_path: str):
     if not os.path.isfile(file_path):
         print('# file not exist:', file_path)
         return
-    tag_o = '__origin__'
-    tag_h = 'hevc8b'
+    tag_o = TAG_ORIGIN
+    tag_h = TAG_HEVC8B
     another_tag_d = {tag_o: tag_h, tag_h: tag_o}
     sizes = {}
     files = {}
@@ -29,7 +42,7 @@ def choose_between_origin_and_hevc8b(file_path: str):
         return
     try:
         another_tag_d = another_tag_d[tag]
-    except ValueError:
+    except KeyError:
         print('# skip untagged video:', file_path)
         return
     another_file = fname + '.' + another_tag_d + ext
@@ -39,9 +52,7 @@ def choose_between_origin_and_hevc8b(file_path: str):
         sizes[another_tag_d] = os.path.getsize(another_file_path)
         files[tag] = file_path
         files[another_tag_d] = another_file_path
-        ratio = sizes[tag_h] / sizes[tag_o]
-        diff = sizes[tag_o] - sizes[tag_h]
-        if ratio <= 0.66 or ratio <= 0.75 and diff >= 50000000:
+        if hevc8b_beats_origin(sizes[tag_o], sizes[tag_h]):
             file = files[tag_o]
             print('* remove large origin:', file)
             os.remove(file)
@@ -53,6 +64,66 @@ def choose_between_origin_and_hevc8b(file_path: str):
         print('# skip single video:', file_path)
 
 
+def index_origin_hevc8b_pairs(root: str, recursive: bool = True) -> dict:
+    """index tagged videos under `root` in one scandir pass,
+    return {(folder, name, ext): {TAG_ORIGIN: (path, size), TAG_HEVC8B: (path, size)}}, single videos included"""
+    pairs = {}
+    folders = [root]
+    while folders:
+        folder = folders.pop()
+        try:
+            entries = list(os.scandir(folder))
+        except OSError as e:
+            print('# skip unreadable folder:', folder, e)
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    folders.append(entry.path)
+                continue
+            fname, ext = os.path.splitext(entry.name)
+            if ext not in VIDEO_FILE_EXTENSIONS:
+                continue
+            name, _, tag = fname.rpartition('.')
+            if not name or tag not in (TAG_ORIGIN, TAG_HEVC8B) or not entry.is_file():
+                continue
+            pairs.setdefault((folder, name, ext), {})[tag] = entry.path, entry.stat().st_size
+    return pairs
+
+
+def choose_between_origin_and_hevc8b_in_tree(root: str, recursive: bool = True, dry_run: bool = False,
+                                             workers: int = None) -> list:
+    """bulk `choose_between_origin_and_hevc8b()` over a directory tree, see `index_origin_hevc8b_pairs()`
+
+    every pair is judged by `hevc8b_beats_origin()`, and the loser is removed (by `workers` threads),
+    unless `dry_run`, return report: [(removed path, kept path, hevc8b/origin size ratio), ...]"""
+    report = []
+    for variants in index_origin_hevc8b_pairs(root, recursive=recursive).values():
+        if len(variants) != 2:
+            continue
+        (origin, origin_size), (hevc8b, hevc8b_size) = variants[TAG_ORIGIN], variants[TAG_HEVC8B]
+        if not origin_size or not hevc8b_size:
+            print('# skip empty video pair:', origin, hevc8b)
+            continue
+        ratio = round(hevc8b_size / origin_size, 3)
+        if hevc8b_beats_origin(origin_size, hevc8b_size):
+            report.append((origin, hevc8b, ratio))
+        else:
+            report.append((hevc8b, origin, ratio))
+    report.sort()
+
+    def remove(x):
+        removed, _, ratio = x
+        tag = os.path.splitext(removed)[0].rpartition('.')[-1]
+        print('* {} large {} ({}):'.format('would remove' if dry_run else 'remove', tag.strip('_'), ratio), removed)
+        if not dry_run:
+            os.remove(removed)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(remove, report))
+    return report
+
+
 def images_to_video(images_folder: str, output_video: str = None):
     pass
 
@@ -72,22 +143,35 @@ def _concat_videos_deprecated(*args):
     os.remove(list_path)
 
 
-def concat_videos(input_list: list, output_path: str):
-    work_dir, _ = os.path.split(os.path.realpath(output_path))
-    list_path = os.path.join(work_dir, '###-ffmpeg-concat-list-temp.txt')
-    with open(list_path, 'w+b') as lf:
-        for i in sorted(input_list):
-            lf.write("file '{}'{}".format(i, os.linesep).encode())
-    os.system(
-        # 'ffmpeg -n -hide_banner -loglevel +level -f concat -safe 0 -i "{}" -c copy "{}"'
-        'ffmpeg -n -hide_banner -loglevel warning -f concat -safe 0 -i "{}" -c copy "{}"'
-            .format(list_path, output_path))
-    os.remove(list_path)
+def new_ffmpeg_caller():
+    """a standalone `FFmpegCaller` per call, since its args are per instance, calls in threads never mix"""
+    from .ffmpeg import FFmpegCaller
+    return FFmpegCaller(banner=False, loglevel='warning', overwrite=False, capture_out_err=True)
+
+
+def run_ffmpeg_job(ffcmd, func_name: str, *args, **kwargs) -> int:
+    """call a method of `FFmpegCaller`, return ffmpeg exit status, 0 for success"""
+    try:
+        getattr(ffcmd, func_name)(*args, **kwargs)
+        return 0
+    except ffcmd.FFmpegError as e:
+        print('# ffmpeg error {}:'.format(e.args[0]), *e.args[1:])
+        return e.args[0]
+
+
+def concat_videos(input_list: list, output_path: str) -> int:
+    """concat videos (sorted by path) by stream copy, the list is fed via stdin, return ffmpeg exit status"""
+    input_list = [os.path.abspath(i) for i in sorted(input_list)]
+    return run_ffmpeg_job(new_ffmpeg_caller(), 'concat', input_list, output_path, copy_all=False, c='copy')
+
+
+def merge_m4s(m4s_list: list, output_path: str) -> int:
+    """mux m4s streams (e.g. dash video & audio) into one file by stream copy, return ffmpeg exit status"""
+    return run_ffmpeg_job(new_ffmpeg_caller(), 'convert', list(m4s_list), output_path, copy_all=False, codec='copy')
 
 
-def merge_m4s(m4s_list: list, output_path: str):
-    cmd = 'ffmpeg -n -hide_banner -loglevel warning '
-    for m in m4s_list:
-        cmd += '-i "{}" '.format(m)
-    cmd += '-codec copy "{}"'.format(output_path)
-    os.system(cmd)
+def run_concat_merge_batch(jobs: list, workers: int = None) -> list:
+    """run jobs of (`concat_videos` or `merge_m4s`, input list, output path) in a thread pool,
+    return exit status of each job, in order"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda job: job[0](*job[1:]), jobs))
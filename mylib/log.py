@@ -20,6 +20,8 @@ def get_logger(logger_name: str, level: str = 'INFO', fmt=LOG_FMT, datefmt=LOG_D
     formatter = logging.Formatter(fmt=fmt, datefmt=datefmt)
     logger = logging.getLogger(logger_name)
     logger.setLevel(level)
+    if logger.handlers and not handlers_l:
+        return logger
     if not handlers_l:
         handlers_l = [logging.StreamHandler()]
     for h in handlers_l:
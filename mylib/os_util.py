@@ -6,10 +6,14 @@ import os
 import shlex
 import shutil
 import signal
+import socket
 import sys
 import tempfile
+import threading
+import uuid
 from contextlib import contextmanager
 from io import FileIO
+from time import monotonic
 from typing import Iterable, Callable, Generator
 
 if os.name == 'nt':
@@ -352,3 +356,114 @@ def write_file_chunk(filepath: str, start: int, stop: int, data: bytes, total: i
         elif f.size < stop:
             f.truncate(stop)
         f[start:stop] = data
+
+
+class LeaseFileLock:
+    """lock files shared through (network) file system, e.g. several hosts mounting the same NFS folder
+
+    acquiring is atomic (O_EXCL create), a lock file contains its owner token,
+    held locks are kept alive by a heartbeat thread touching their mtime,
+    a lock whose mtime and owner are seen unchanged for longer than `lease` seconds (by local monotonic clock, so
+    clock skew between hosts and file server does not matter) is considered stale, thus could be reclaimed by others"""
+
+    def __init__(self, owner: str = None, lease: float = 120, heartbeat: float = 30):
+        self.owner = owner or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lease = lease
+        self.heartbeat = heartbeat
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._beat_thread = None
+        self._stop = threading.Event()
+        self._seen = {}  # {lock_path: ((mtime_ns, owner), monotonic time since when it is seen unchanged)}
+
+    def owner_of(self, lock_path: str) -> str or None:
+        try:
+            with open(lock_path, encoding='utf8') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def observe(self, lock_path: str) -> tuple or None:
+        """(mtime_ns, owner) of a lock file, None if not exist"""
+        try:
+            mtime_ns = os.stat(lock_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        return mtime_ns, self.owner_of(lock_path)
+
+    def is_stale(self, lock_path: str) -> bool:
+        """True if the lock is seen unchanged for more than `lease` seconds,
+        a lock seen for the first time is never stale, so it takes repeated checks to find a stale lock"""
+        state = self.observe(lock_path)
+        if state is None:
+            self._seen.pop(lock_path, None)
+            return False
+        seen = self._seen.get(lock_path)
+        if not seen or seen[0] != state:
+            self._seen[lock_path] = state, monotonic()
+            return False
+        return monotonic() - seen[1] > self.lease
+
+    def acquire(self, lock_path: str, reclaim_stale: bool = True) -> bool:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if reclaim_stale and self.is_stale(lock_path) and self.reclaim(lock_path):
+                return self.acquire(lock_path, reclaim_stale=False)
+            return False
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            f.write(self.owner)
+        with self._held_lock:
+            self._held.add(lock_path)
+        self.ensure_heartbeat()
+        return True
+
+    def reclaim(self, lock_path: str) -> bool:
+        """move a stale lock away, only one of the competitors wins the rename
+
+        the moved file is then compared with the stale state seen by `is_stale()`, if it differs, it is a fresh lock
+        just taken by another competitor, which is put back (if the path is still free) and False is returned"""
+        seen = self._seen.pop(lock_path, None)
+        graveyard = '{}.{}.stale'.format(lock_path, uuid.uuid4().hex[:8])
+        try:
+            os.rename(lock_path, graveyard)
+        except OSError:
+            return False
+        if not seen or self.observe(graveyard) != seen[0]:
+            try:
+                os.link(graveyard, lock_path)
+            except OSError:
+                pass
+            os.remove(graveyard)
+            return False
+        os.remove(graveyard)
+        return True
+
+    def release(self, lock_path: str, remove_file: bool = True):
+        with self._held_lock:
+            if lock_path not in self._held:
+                return
+            self._held.discard(lock_path)
+        if remove_file and self.owner_of(lock_path) == self.owner:
+            os.remove(lock_path)
+
+    def ensure_heartbeat(self):
+        if self._beat_thread and self._beat_thread.is_alive():
+            return
+        self._stop.clear()
+        self._beat_thread = threading.Thread(target=self._beat, daemon=True)
+        self._beat_thread.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat):
+            with self._held_lock:
+                held = list(self._held)
+            for lock_path in held:
+                try:
+                    os.utime(lock_path)
+                except FileNotFoundError:
+                    with self._held_lock:
+                        self._held.discard(lock_path)
+
+    def stop_heartbeat(self):
+        self._stop.set()
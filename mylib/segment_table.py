@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# encoding=utf8
+"""columnar view of segments info of `FFmpegSegmentsContainer`, for analytics over many segments (numpy needed)"""
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .os_util import read_json_file
+
+COLUMNS = ('duration', 'size', 'bit_rate', 'start_time', 'width', 'height', 'frame_rate', 'complexity')
+
+
+class SegmentTable:
+    """per video stream, numpy arrays of segments info, ordered by segment number
+
+    `files[stream_id]` is the list of segment filenames, `columns[stream_id][name]` is the array of a field in
+    `COLUMNS`, missing fields (e.g. segment without single video stream) are nan"""
+
+    def __init__(self, segments: Dict[str, Dict[str, dict]]):
+        """:param segments: `input_data[S_SEGMENT]` of a container, i.e. {stream_id: {segment_file: info}}"""
+        self.files = {}
+        self.columns = {}
+        for stream_id, d in segments.items():
+            files = sorted(d, key=lambda x: int(os.path.splitext(x)[0]))
+            self.files[stream_id] = files
+            self.columns[stream_id] = {
+                name: np.fromiter((d[f].get(name, np.nan) for f in files), dtype=np.float64, count=len(files))
+                for name in COLUMNS}
+
+    @classmethod
+    def from_json(cls, input_json: str, segment_key: str = 'segment'):
+        return cls(read_json_file(input_json)[segment_key])
+
+    def __len__(self):
+        return sum([len(files) for files in self.files.values()])
+
+    def column(self, stream_id, name: str) -> np.ndarray:
+        return self.columns[stream_id][name]
+
+    def totals(self, stream_id) -> dict:
+        c = self.columns[stream_id]
+        return {'duration': float(np.nansum(c['duration'])), 'size': int(np.nansum(c['size'])),
+                'count': len(self.files[stream_id])}
+
+    def stratified_sample(self, stream_id, samples: int, by: str = 'bit_rate', min_duration: float = 1) -> List[str]:
+        """sort segments (not shorter than `min_duration`) by a field, divide them into `samples` strata,
+        return filenames of the median segment of each stratum"""
+        c = self.columns[stream_id]
+        candidates = np.flatnonzero(c['duration'] >= min_duration)
+        if not candidates.size:
+            return []
+        candidates = candidates[np.argsort(c[by][candidates], kind='stable')]
+        n = min(samples, candidates.size)
+        bounds = np.arange(n + 1) * candidates.size // n
+        medians = (bounds[:-1] + bounds[1:]) // 2
+        files = self.files[stream_id]
+        return [files[i] for i in candidates[medians]]
+
+    def weighted_sums(self, stream_id, x: str = 'bit_rate') -> Tuple[float, float]:
+        """sum(w) and sum(w * x), with w = duration / 8, for estimating output size as sum(w * (a + b * x))"""
+        c = self.columns[stream_id]
+        w = c['duration'] / 8
+        return float(np.nansum(w)), float(np.nansum(w * c[x]))
+
+    def outliers(self, stream_id, name: str = 'bit_rate', k: float = 1.5) -> List[str]:
+        """filenames of segments whose field is beyond `k` times the interquartile range from the quartiles"""
+        values = self.columns[stream_id][name]
+        q1, q3 = np.nanpercentile(values, [25, 75])
+        iqr = q3 - q1
+        mask = (values < q1 - k * iqr) | (values > q3 + k * iqr)
+        files = self.files[stream_id]
+        return [files[i] for i in np.flatnonzero(mask)]
+
+    def histogram(self, stream_id, name: str = 'bit_rate', bins: int = 20, weight: str = 'duration') -> dict:
+        """histogram of a field, weighted by another field (None for count), return bin edges and counts"""
+        c = self.columns[stream_id]
+        values = c[name]
+        valid = ~np.isnan(values)
+        weights = c[weight][valid] if weight else None
+        counts, edges = np.histogram(values[valid], bins=bins, weights=weights)
+        return {'edges': edges.tolist(), 'counts': counts.tolist()}
+
+    def partition(self, parts: int, weight: str = 'duration') -> List[List[Tuple[str, str]]]:
+        """split all segments into `parts` runs of contiguous segments with about equal total weight,
+        return lists of (stream_id, segment_file)"""
+        keys = [(stream_id, f) for stream_id, files in self.files.items() for f in files]
+        if not keys:
+            return [[] for _ in range(parts)]
+        w = np.nan_to_num(np.concatenate([self.columns[stream_id][weight] for stream_id in self.files]))
+        cumsum = np.cumsum(w)
+        cuts = np.searchsorted(cumsum, cumsum[-1] * np.arange(1, parts) / parts, side='right')
+        bounds = [0, *cuts.tolist(), len(keys)]
+        return [keys[bounds[i]:bounds[i + 1]] for i in range(parts)]
+
+    def pixels(self, default_frame_rate: float = 30) -> float:
+        """total number of pixels of all segments to encode, i.e. sum(duration * frame_rate * width * height)"""
+        total = 0.
+        for c in self.columns.values():
+            frame_rate = np.where(np.isnan(c['frame_rate']), default_frame_rate, c['frame_rate'])
+            total += float(np.nansum(c['duration'] * frame_rate * c['width'] * c['height']))
+        return total
@@ -18,7 +18,7 @@ import lxml.html
 import requests.utils
 
 from .log import get_logger, LOG_FMT_MESSAGE_ONLY
-from .os_util import SubscriptableFileIO, fs_touch, write_file_chunk
+from .os_util import SubscriptableFileIO, fs_touch
 from .tricks import JSONType, meta_new_thread, meta_gen_retry, singleton
 
 MAGIC_TXT_NETSCAPE_HTTP_COOKIE_FILE = '# Netscape HTTP Cookie File'
@@ -245,8 +245,9 @@ def human_filesize(bytes_n: int, no_space=True):
 
 class Download:
     def __init__(self, response: requests.Response, filepath: str = None,
-                 content: bytes = None, no_content: bool = False):
-        content = b'' if no_content else content or response.content
+                 content: bytes = None, no_content: bool = False, size: int = None):
+        """:param size: size of data already streamed into `filepath`, content is not kept then"""
+        content = b'' if no_content or size is not None else content or response.content
         if not response.ok:
             raise HTTPResponseInspection(response, content)
         self.id = id(response)
@@ -255,7 +256,7 @@ class Download:
         self.reason = response.reason
         self.url = response.request.url
         self.data = content
-        self.size = len(self.data)
+        self.size = len(self.data) if size is None else size
         content_length = int(response.headers.get('Content-Length', '-1'))
         if content_length >= 0 and content_length != self.size:
             raise HTTPIncomplete(content_length, self.size)
@@ -419,6 +420,8 @@ class DownloadPool(ThreadPoolExecutor):
         return {'split': split, 'size': size}
 
     def request_data(self, url, filepath, start=0, stop=0, **kwargs_for_requests) -> Download:
+        """stream response body into its place in `filepath` through a single file handle and a reused buffer,
+        the returned `Download` keeps no data, only its size and range"""
         # chunk_size = requests.models.CONTENT_CHUNK_SIZE
         chunk_size = 4096 * 1024
         kwargs = make_kwargs_for_lib_requests(**kwargs_for_requests)
@@ -430,19 +433,37 @@ class DownloadPool(ThreadPoolExecutor):
             kwargs['headers']['Range'] = 'bytes={}'.format(start)
         r = requests.get(url, stream=True, timeout=self.timeout, **kwargs)
         self.logger.debug(HTTPResponseInspection(r, no_content=True))
-
-        content = b''
-        stop = 0
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            self.recv_size_queue.put((time(), len(chunk)))
-            start = stop
-            stop = start + len(chunk)
-            content += chunk
-            total = len(content)
-            write_file_chunk(filepath, start, stop, chunk, total)
-        self.logger.debug(HTTPResponseInspection(r, content=content))
-        d = Download(r, filepath, content=content)
-        return d
+        if not r.ok:
+            raise HTTPResponseInspection(r)
+
+        offset, total = 0, None
+        if r.status_code == 206:
+            offset, _, total = [int(s) for s in
+                                re.search(r'(\d+)-(\d+)/(\d+)', r.headers['Content-Range']).groups()]
+        elif 'Content-Encoding' not in r.headers and 'Content-Length' in r.headers:
+            total = int(r.headers['Content-Length'])
+        size = 0
+        with open(filepath, 'r+b' if os.path.isfile(filepath) else 'wb') as f:
+            if total is not None and os.fstat(f.fileno()).st_size != total:
+                f.truncate(total)  # preallocate
+            f.seek(offset)
+            if 'Content-Encoding' in r.headers:  # let requests decode it
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    size += len(chunk)
+                    self.recv_size_queue.put((time(), len(chunk)))
+            else:
+                buffer = memoryview(bytearray(chunk_size))
+                while True:
+                    n = r.raw.readinto(buffer)
+                    if not n:
+                        break
+                    f.write(buffer[:n])
+                    size += n
+                    self.recv_size_queue.put((time(), n))
+            if total is None:
+                f.truncate(offset + size)
+        return Download(r, filepath, size=size)
 
     def write_file(self, dl_obj: Download):
         url = dl_obj.url
@@ -470,7 +491,6 @@ class DownloadPool(ThreadPoolExecutor):
                 break
         else:
             return
-        self.write_file(dl_obj)
         os.rename(tmpfile, filepath)
         self.log_file_done(filepath, dl_obj.size)
 